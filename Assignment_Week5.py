@@ -1,80 +1,155 @@
 
 import argparse
+import multiprocessing
+import os
+import time
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
+import bme163_io
+
+NUCLEOTIDES = 'ATGC'
+# byte value -> count column: A, T, G, C (either case) to 0-3, N and every other ambiguity
+# code to 4, and the padding byte used for short sequences to 5, which is never counted
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+BASE_CODES[0] = 5
+for code, nucleotide in enumerate(NUCLEOTIDES):
+    BASE_CODES[ord(nucleotide)] = BASE_CODES[ord(nucleotide.lower())] = code
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Generate sequence logos for splice sites.')
-    parser.add_argument('-s', '--splice_file', required=True)
-    parser.add_argument('-o', '--output_file', required=True)
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-s', '--splice_file', nargs='+', help='Splice site FASTA file(s); more than one runs in batch mode')
+    inputs.add_argument('--manifest', help='File listing splice FASTAs (path [output name] per line) to render in one batch')
+    parser.add_argument('-o', '--output_file', required=True, help='Output file name (output directory in batch mode)')
     parser.add_argument('-A', '--A_image', required=True)
     parser.add_argument('-T', '--T_image', required=True)
     parser.add_argument('-G', '--G_image', required=True)
     parser.add_argument('-C', '--C_image', required=True)
+    parser.add_argument('-m', '--mmap', action='store_true', help='Read the splice file through a memory map')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Worker processes in batch mode')
     return parser.parse_args()
 
-def read_sequences(file_path):
-    sequences = {'5SS': [], '3SS': []}
-    with open(file_path, 'r') as file:
-        seq = ''
-        category = None
-        for line in file:
-            line = line.strip()
-            if line.startswith('>'):
-                if seq:
-                    sequences[category].append(seq)
-                category = '5SS' if "5'" in line else '3SS'
-                seq = ''
-            else:
-                seq += line
-        if seq:
-            sequences[category].append(seq)
-    return sequences
-
-def calculate_frequencies(sequences):
-    length = 20 
-    nucleotides = 'ATGC'
-    freqs = {'5SS': np.zeros((length, 4)), '3SS': np.zeros((length, 4))}
-    idx = {n: i for i, n in enumerate(nucleotides)}
-    
-    for key, seqs in sequences.items():
-        for seq in seqs:
-            for i, nuc in enumerate(seq):
-                freqs[key][i, idx[nuc]] += 1
-        freqs[key] /= len(seqs)
+# yields (category, sequence bytes) for each FASTA record, classified by its header
+def read_sequences(file_path, use_mmap=False):
+    for header, seq in bme163_io.iter_fasta(file_path, use_mmap):
+        yield '5SS' if b"5'" in (header or b'') else '3SS', seq
+
+# packs sequences into a (sequences, positions) uint8 code matrix, padding short ones
+def encode_sequences(seqs):
+    seqs = [seq.encode() if isinstance(seq, str) else seq for seq in seqs]
+    length = max(map(len, seqs), default=0)
+    packed = b''.join(seq.ljust(length, b'\0') for seq in seqs)
+    return BASE_CODES[np.frombuffer(packed, dtype=np.uint8)].reshape(len(seqs), length)
+
+# position by base counts for a code matrix; columns are A, T, G, C, ambiguous
+def count_bases(codes):
+    length = codes.shape[1]
+    flat = (np.arange(length, dtype=np.int64) * 6 + codes).ravel()
+    return np.bincount(flat, minlength=length * 6).reshape(length, 6)[:, :5]
+
+# adds one chunk's counts to counts[key], growing it when the chunk holds longer sequences
+def accumulate_counts(counts, key, codes):
+    chunk = count_bases(codes)
+    total = counts.get(key, np.zeros((0, 5), dtype=np.int64))
+    if len(chunk) > len(total):
+        total = np.pad(total, ((0, len(chunk) - len(total)), (0, 0)))
+    total[:len(chunk)] += chunk
+    counts[key] = total
 
+# base frequencies at each position among the unambiguous bases there
+def counts_to_frequencies(counts):
+    freqs = {}
+    for key, total in counts.items():
+        called = total[:, :4].sum(axis=1, keepdims=True)
+        freqs[key] = total[:, :4] / np.maximum(called, 1)
     return freqs
 
-def plot_sequence_logos(freqs, args):
+# counts (category, sequence) records as they stream in, holding at most chunk_size
+# sequences per category at a time
+def count_sequences(records, chunk_size=1 << 16):
+    counts = {'5SS': np.zeros((0, 5), dtype=np.int64), '3SS': np.zeros((0, 5), dtype=np.int64)}
+    pending = {key: [] for key in counts}
+    for key, seq in records:
+        pending[key].append(seq)
+        if len(pending[key]) == chunk_size:
+            accumulate_counts(counts, key, encode_sequences(pending[key]))
+            pending[key] = []
+    for key, seqs in pending.items():
+        if seqs:
+            accumulate_counts(counts, key, encode_sequences(seqs))
+    return counts
+
+def calculate_frequencies(records, chunk_size=1 << 16):
+    return counts_to_frequencies(count_sequences(records, chunk_size))
+
+# every counted sequence has a base (or ambiguity code) at its first position
+def sequence_total(counts):
+    return int(sum(total[0].sum() for total in counts.values() if len(total)))
+
+# decoded glyph images as RGBA float arrays, keyed by file path
+glyph_cache = {}
+
+def load_glyph(path):
+    if path not in glyph_cache:
+        img = mpimg.imread(path)
+        if img.dtype == np.uint8:
+            img = img / 255
+        if img.shape[2] == 3:
+            img = np.dstack([img, np.ones(img.shape[:2])])
+        glyph_cache[path] = img.astype(np.float32)
+    return glyph_cache[path]
+
+# nearest-neighbour resize of an image to rows x columns
+def resize_glyph(img, rows, columns):
+    row_index = ((np.arange(rows) + 0.5) * img.shape[0] / rows).astype(int)
+    column_index = ((np.arange(columns) + 0.5) * img.shape[1] / columns).astype(int)
+    return img[row_index[:, None], column_index]
+
+# one RGBA raster (bottom row first) for a whole logo: each position's three most frequent
+# bases stacked smallest first, scaled by frequency times information content
+def compose_logo(freqs, glyphs, width_px, height_px, max_bits=2):
+    length = len(freqs)
+    raster = np.zeros((height_px, width_px, 4), dtype=np.float32)
+    info = max_bits + np.sum(freqs * np.log2(freqs + 1e-10), axis=1)
+    heights = freqs * info[:, None]
+    order = np.argsort(-freqs, axis=1, kind='stable')[:, 2::-1]
+    column_edges = np.round(np.linspace(0, width_px, length + 1)).astype(int)
+    for pos in range(length):
+        left, right = column_edges[pos], column_edges[pos + 1]
+        bottom = 0
+        for idx in order[pos]:
+            top = bottom + heights[pos, idx]
+            low, high = (np.clip(np.round(np.array([bottom, top]) / max_bits * height_px), 0, height_px)).astype(int)
+            if high > low and right > left:
+                raster[low:high, left:right] = resize_glyph(glyphs[idx], high - low, right - left)[::-1]
+            bottom = top
+    return raster
+
+# figure with both logo panels laid out and labelled, and an empty image in each for
+# plot_sequence_logos to fill; reused across files in batch mode
+def logo_template(dpi=300):
     figureWidth, figureHeight = 5, 2
-    plt.figure(figsize=(figureWidth, figureHeight))
+    figure = plt.figure(figsize=(figureWidth, figureHeight))
     panelWidth, panelHeight = 1.5, 0.5
     panel1 = plt.axes([0.5 / figureWidth, 0.3, panelWidth / figureWidth, panelHeight / figureHeight], frameon=True)
     panel2 = plt.axes([2.2 / figureWidth, 0.3, panelWidth / figureWidth, panelHeight / figureHeight], frameon=True)
     
     panel1.tick_params(axis='y', labelsize=4)
-
+    # the raster is built at twice the output resolution of the panel
+    width_px, height_px = int(panelWidth * dpi * 2), int(panelHeight * dpi * 2)
+    images = {}
 
     for panel, key in zip([panel1, panel2], ['5SS', '3SS']):
-        for pos in range(20):
-            base_freqs = [(freqs[key][pos, i], i) for i in range(4)]
-            base_freqs.sort(reverse=True, key=lambda x: x[0])  
-            total_info = -np.sum([bf[0] * np.log2(bf[0] + 1e-10) for bf in base_freqs])
-            info_norm = 2 - total_info
-            bottom = 0
-            for freq, idx in reversed(base_freqs[:3]): 
-                height = freq * info_norm
-                img = mpimg.imread([args.A_image, args.T_image, args.G_image, args.C_image][idx])
-                panel.imshow(img, extent=(pos-10, pos-9, bottom, bottom+height), aspect='auto')
-                bottom += height
+        images[key] = panel.imshow(np.zeros((height_px, width_px, 4), dtype=np.float32),
+                                   extent=(-10, 10, 0, 2), origin='lower', aspect='auto')
         
         panel.set_xlim(-10, 10)
         panel.set_ylim(0, 2)
         panel.set_xticks([-10, -5, 0, 5, 10])
         panel.set_xticklabels(['-10', '-5', '0', '5', '10'],fontsize=7.4)
         panel.set_xlabel('Distance to\nSplice Site',fontsize=7.4)
-        panel.set_title(f"{key.replace('SS', '\'SS')}",fontsize=7.4)
+        panel.set_title(key.replace('SS', "'SS"),fontsize=7.4)
 
        
         panel.axvline(0, color='black', linewidth=0.5)
@@ -88,13 +163,85 @@ def plot_sequence_logos(freqs, args):
     panel2.set_yticks([])
 
     plt.tight_layout()
-    plt.savefig(args.output_file, dpi=300)
+    return {'figure': figure, 'images': images, 'size': (width_px, height_px), 'dpi': dpi}
+
+def plot_sequence_logos(freqs, glyphs, output_file, template):
+    width_px, height_px = template['size']
+    for key, image in template['images'].items():
+        length = len(freqs[key])
+        image.set_data(compose_logo(freqs[key], glyphs, width_px, height_px))
+        image.set_extent((-(length // 2), length - length // 2, 0, 2))
+        image.axes.set_xlim(-(length // 2), length - length // 2)
+        image.axes.set_ylim(0, 2)
+    template['figure'].savefig(output_file, dpi=template['dpi'])
+
+# output name for a splice file: its base name without the compression and FASTA extensions
+def output_name(path):
+    name = os.path.basename(path)
+    for suffix in ('.gz', '.bgz'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return os.path.splitext(name)[0] + '.png'
+
+# (splice file, output file) pairs from a manifest of "path [output name]" lines, or from the
+# splice files themselves, with outputs named after each input; two inputs that would write the
+# same output are an error rather than one silently overwriting the other
+def batch_jobs(args):
+    if args.manifest:
+        entries = [line.split() for line in open(args.manifest) if line.strip() and not line.startswith('#')]
+    else:
+        entries = [[path] for path in args.splice_file]
+    jobs, sources = [], {}
+    for fields in entries:
+        output_file = os.path.join(args.output_file, fields[1] if len(fields) > 1 else output_name(fields[0]))
+        sources.setdefault(output_file, []).append(fields[0])
+        jobs.append((fields[0], output_file))
+    clashes = [f'{output_file}: {", ".join(paths)}' for output_file, paths in sources.items() if len(paths) > 1]
+    if clashes:
+        raise SystemExit('several inputs map to the same output (name them in a --manifest):\n' + '\n'.join(clashes))
+    return jobs
+
+# decoded glyphs shared with batch workers (inherited on fork, sent once per worker otherwise);
+# each worker builds its figure template on its first file and reuses it
+batch_state = {}
+
+def init_batch_worker(glyphs, use_mmap):
+    batch_state.update(glyphs=glyphs, use_mmap=use_mmap)
+
+def render_batch_file(job):
+    splice_file, output_file = job
+    began = time.perf_counter()
+    if 'template' not in batch_state:
+        batch_state['template'] = logo_template()
+    counts = count_sequences(read_sequences(splice_file, batch_state['use_mmap']))
+    plot_sequence_logos(counts_to_frequencies(counts), batch_state['glyphs'], output_file, batch_state['template'])
+    return splice_file, sequence_total(counts), time.perf_counter() - began
+
+# count and render every splice file across a process pool
+def run_batch(args, glyphs):
+    jobs = batch_jobs(args)
+    os.makedirs(args.output_file, exist_ok=True)
+    began = time.perf_counter()
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    sequences = 0
+    with context.Pool(max(1, min(args.jobs, len(jobs))), initializer=init_batch_worker, initargs=(glyphs, args.mmap)) as pool:
+        # imap keeps results in input order whatever order workers finish in
+        for splice_file, count, seconds in pool.imap(render_batch_file, jobs):
+            sequences += count
+            print(f'{splice_file}\t{count} sequences\t{seconds:.2f}s')
+    elapsed = time.perf_counter() - began
+    print(f'rendered {len(jobs)} files ({sequences} sequences) in {elapsed:.2f}s: '
+          f'{len(jobs) / elapsed:.2f} files/s, {sequences / elapsed:.0f} sequences/s')
 
 def main():
     args = parse_arguments()
-    sequences = read_sequences(args.splice_file)
-    frequencies = calculate_frequencies(sequences)
-    plot_sequence_logos(frequencies, args)
+    glyphs = [load_glyph(path) for path in [args.A_image, args.T_image, args.G_image, args.C_image]]
+    if args.manifest or len(args.splice_file) > 1:
+        run_batch(args, glyphs)
+        return
+    frequencies = calculate_frequencies(read_sequences(args.splice_file[0], args.mmap))
+    plot_sequence_logos(frequencies, glyphs, args.output_file, logo_template())
 
 if __name__ == '__main__':
     main()
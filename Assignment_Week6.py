@@ -2,48 +2,101 @@ import numpy as np
 import matplotlib.pyplot as plt
 import argparse
 import matplotlib.colors as mcolors
+import bme163_io
 
 plt.style.use('BME163.mplstyle') 
 def parse_args():
     parser = argparse.ArgumentParser(description="Generate a heatmap from gene expression data.")
     parser.add_argument('-e', '--exp_file', required=True, help='Expression data file path')
     parser.add_argument('-p', '--phase_file', required=True, help='Phase data file path')
-    parser.add_argument('-g', '--genes', help='Comma-separated list of genes for tick marks', default='')
+    parser.add_argument('-g', '--genes', help='Comma-separated list of genes (names or Ensembl IDs) for tick marks',
+                        default='Clock,Insig2,Nr1d1,Dbp,Per3,Per1,Per2,Cry1,Arntl')
+    parser.add_argument('-a', '--aggregate', choices=['mean', 'max'], default='mean', help='How genes sharing an output pixel row are combined')
+    parser.add_argument('-o', '--output', default='/Users/hemap/Downloads/Hema_Prasanna_Assignment_Week6_corrected.png', help='Output PNG file path')
     return parser.parse_args()
 
+# min-max scale every row to whole percents in one broadcast; constant rows scale to 0
 def normalize_data(values):
-    values = np.array(values, dtype=float)
-    return ((values - np.min(values)) / (np.max(values) - np.min(values))) * 100
-
-def load_data(filepath, delimiter='\t', header=True):
-    with open(filepath, 'r') as file:
-        if header:
-            headers = file.readline().strip().split(delimiter)
-        data = [line.strip().split(delimiter) for line in file]
-    return headers, data
-
-def interpolate_data(data, factor=2):
-    new_length = data.shape[0] * factor
-    x_original = np.arange(data.shape[0])
-    x_new = np.linspace(0, data.shape[0] - 1, new_length)
-    data_interpolated = np.array([np.interp(x_new, x_original, data[:, i]) for i in range(data.shape[1])]).T
-    return data_interpolated
-
-def main():
-    args = parse_args()
-    exp_headers, exp_data = load_data(args.exp_file)
-    phase_headers, phase_data = load_data(args.phase_file)
-
+    values = np.asarray(values, dtype=np.float32)
+    low = values.min(axis=1, keepdims=True)
+    span = values.max(axis=1, keepdims=True) - low
+    scaled = np.divide(values - low, span, out=np.zeros_like(values), where=span > 0)
+    return np.floor(scaled * 100)
+
+# tab-separated table split in bulk, keeping only the columns select(headers) names (all of them
+# without select); returns the kept header names and an array of their byte fields, one row per line
+def load_data(filepath, select=None, delimiter=b'\t'):
+    headers = bme163_io.header_fields(filepath, delimiter)
+    columns = select(headers) if select else headers
+    return columns, bme163_io.read_table(filepath, columns=columns, delimiter=delimiter, header=True)[1]
+
+# the expression columns the heatmap uses: Ensembl IDs, the FPKM time points and, when there is
+# one, the gene name column for tick labels
+def expression_columns(headers):
+    name = next((header for header in headers if 'name' in header.lower() or header.lower() in ('gene', 'symbol')), None)
+    return ['Ensembl_ID'] + [header for header in headers if 'FPKM_CT' in header] + ([name] if name else [])
+
+# the gene ID (first) and peak phase columns
+def phase_columns(headers):
+    return [headers[0], 'Peak_phase(CT)']
+
+# distinct keys (sorted) with the first and last row each appears on, the position and the
+# value a dict built over the rows would keep
+def key_rows(keys):
+    unique, first = np.unique(keys, return_index=True)
+    _, last = np.unique(keys[::-1], return_index=True)
+    return unique, first, len(keys) - 1 - last
+
+# linear interpolation of every column at once at fractional row positions x_new
+def interpolate_data(data, x_new):
+    x_new = np.clip(x_new, 0, data.shape[0] - 1)
+    below = np.floor(x_new).astype(int)
+    above = np.minimum(below + 1, data.shape[0] - 1)
+    weight = (x_new - below).astype(data.dtype)[:, None]
+    return data[below] + (data[above] - data[below]) * weight
+
+# the matrix with exactly `rows` rows for drawing: with more genes than rows, consecutive genes
+# are binned and reduced by mean or max; with fewer, it is interpolated at the row centres
+def resample_rows(data, rows, aggregate='mean'):
+    genes = data.shape[0]
+    if genes == 0:
+        return data
+    if genes > rows:
+        starts = np.arange(rows) * genes // rows
+        if aggregate == 'max':
+            return np.maximum.reduceat(data, starts, axis=0)
+        return np.add.reduceat(data, starts, axis=0) / np.diff(np.append(starts, genes)).astype(data.dtype)[:, None]
+    return interpolate_data(data, (np.arange(rows) + 0.5) * genes / rows - 0.5)
+
+# sorted row of every gene, keyed by Ensembl ID and, for the first gene carrying it, by name
+def gene_row_index(sorted_genes, names=()):
+    index = {}
+    for row, name in enumerate(names):
+        index.setdefault(name, row)
+    index.update(zip(sorted_genes, range(len(sorted_genes))))
+    return index
+
+# genes with a phase, ordered by phase and then by where they first appear in the table: their
+# IDs, normalized FPKM rows, the tick row of every ID and name, and the FPKM column count
+def build_matrix(exp_headers, exp_data, phase_headers, phase_data):
     gene_index = exp_headers.index('Ensembl_ID')
     FPKM_indices = [i for i, header in enumerate(exp_headers) if 'FPKM_CT' in header]
-    phase_dict = {row[0].strip(): float(row[phase_headers.index('Peak_phase(CT)')]) for row in phase_data}
-
-    exp_dict = {row[gene_index].strip(): np.array([float(row[i]) for i in FPKM_indices]) for row in exp_data if row[gene_index].strip() in phase_dict}
-    sorted_genes = sorted(exp_dict.keys(), key=lambda x: phase_dict[x])
-    normalized_matrix = np.array([normalize_data(exp_dict[gene]).astype(int) for gene in sorted_genes])
-
-    normalized_matrix = interpolate_data(normalized_matrix, factor=5) 
-
+    phase_genes, _, phase_rows = key_rows(np.char.strip(phase_data[:, 0]))
+    phases = phase_data[phase_rows, phase_headers.index('Peak_phase(CT)')].astype(float)
+
+    genes, first_rows, last_rows = key_rows(np.char.strip(exp_data[:, gene_index]))
+    slot = np.minimum(np.searchsorted(phase_genes, genes), max(len(phase_genes) - 1, 0))
+    found = np.flatnonzero(phase_genes[slot] == genes) if len(phase_genes) else np.zeros(0, dtype=int)
+    order = found[np.lexsort((first_rows[found], phases[slot[found]]))]
+    sorted_genes = genes[order].astype(str)
+    exp_matrix = exp_data[last_rows[order]][:, FPKM_indices].astype(np.float32)
+    normalized_matrix = normalize_data(exp_matrix)
+    name_index = next((i for i, header in enumerate(exp_headers)
+                       if 'name' in header.lower() or header.lower() in ('gene', 'symbol')), None)
+    names = np.char.strip(exp_data[last_rows[order], name_index]).astype(str) if name_index is not None else ()
+    return sorted_genes, normalized_matrix, gene_row_index(sorted_genes, names), len(FPKM_indices)
+
+def plot_heatmap(display_matrix, gene_count, gene_rows, column_count, genes, output, dpi=600):
     viridian = mcolors.LinearSegmentedColormap.from_list("viridian", [
         (253/255, 231/255, 37/255), (94/255, 201/255, 98/255),
         (33/255, 145/255, 140/255), (59/255, 82/255, 139/255),
@@ -53,15 +106,21 @@ def main():
     panel1 = plt.axes([0.7/5 , 0.3/3 , 0.75/5 , 2.5/3],frameon=True)
     panel2 = plt.axes([1.5/5, 1.45/3, 0.1/5, 0.2/3], frameon=True) 
 
-    heatmap = panel1.imshow(normalized_matrix, aspect='auto', cmap=viridian, interpolation='nearest')
-    tick_positions = np.arange(len(FPKM_indices))
+    # the extent keeps y in gene rows whatever the resampling, so ticks go at gene_rows
+    heatmap = panel1.imshow(display_matrix, aspect='auto', cmap=viridian, interpolation='nearest',
+                            extent=(-0.5, column_count - 0.5, gene_count - 0.5, -0.5))
+    tick_positions = np.arange(column_count)
     panel1.set_xticks(tick_positions)
-    tick_labels = [f'{3 * i}' if i % 2 == 0 else '' for i in range(len(FPKM_indices))]
+    tick_labels = [f'{3 * i}' if i % 2 == 0 else '' for i in range(column_count)]
     panel1.set_xticklabels(tick_labels, fontsize=8)
     panel1.set_xlabel('CT',fontsize=8)
 
-    specific_genes = ['Clock', 'Insig2', 'Nr1d1', 'Dbp', 'Per3', 'Per1', 'Per2', 'Cry1', 'Arntl']
-    gene_positions = [5 ,441, 1890, 3225, 3696, 3990, 4569, 5098, 6300] 
+    requested_genes = [gene.strip() for gene in genes.split(',') if gene.strip()]
+    missing = [gene for gene in requested_genes if gene not in gene_rows]
+    if missing:
+        print(f"genes not in the heatmap, no tick drawn: {', '.join(missing)}")
+    specific_genes = [gene for gene in requested_genes if gene in gene_rows]
+    gene_positions = [gene_rows[gene] for gene in specific_genes]
     panel1.set_yticks(gene_positions)
     panel1.set_yticklabels(specific_genes, fontsize=8,)
 
@@ -70,9 +129,23 @@ def main():
 
 
     cbar = plt.colorbar(heatmap, cax=panel2, orientation='vertical')
+    cbar.set_ticks(heatmap.get_clim())
     cbar.ax.set_yticklabels(['Min', 'Max'], fontsize=8)
 
-    plt.savefig("/Users/hemap/Downloads/Hema_Prasanna_Assignment_Week6_corrected.png", dpi=600)
+    plt.savefig(output, dpi=dpi)
+    return fig
+
+def main():
+    args = parse_args()
+    exp_headers, exp_data = load_data(args.exp_file, expression_columns)
+    phase_headers, phase_data = load_data(args.phase_file, phase_columns)
+    sorted_genes, normalized_matrix, gene_rows, column_count = build_matrix(exp_headers, exp_data, phase_headers, phase_data)
+
+    # one matrix row per output pixel row of the 2.5 inch panel at 600 dpi
+    dpi = 600
+    display_matrix = resample_rows(normalized_matrix, int(2.5 * dpi), args.aggregate)
+
+    plot_heatmap(display_matrix, len(sorted_genes), gene_rows, column_count, args.genes, args.output, dpi)
     plt.show()
 
 if __name__ == "__main__":
@@ -1,8 +1,20 @@
 import matplotlib.pyplot as plt
 import matplotlib.patches as mplpatches
+from matplotlib.collections import PatchCollection
 import numpy as np
 import argparse
 
+# draw `steps` evenly spaced colours of a colormap as one image filling extent (left, right,
+# bottom, top), optionally outlined
+def plot_gradient(panel, cmap, steps, extent, outline_color=None, outline_width=1.5):
+    colors = plt.get_cmap(cmap)(np.linspace(0, 1, steps))[np.newaxis]
+    image = panel.imshow(colors, extent=extent, aspect='auto', interpolation='nearest')
+    if outline_color is not None:
+        left, right, bottom, top = extent
+        panel.add_patch(mplpatches.Rectangle((left, bottom), right - left, top - bottom, fill=False,
+                                             edgecolor=outline_color, linewidth=outline_width))
+    return image
+
 # setup the CL argument parsing
 parser = argparse.ArgumentParser()
 parser.add_argument('-o', '--outFile', type=str, required=True, help='Output file name')
@@ -37,10 +49,9 @@ circle_colors = [
     (155/255, 42/255, 90/255),  # RB12
 ]
 
-# plot the circles in the left panel
-for i in range(len(circle_colors)):
-    circle = mplpatches.Circle((2 + 1*i, 8), 1, facecolor='none', edgecolor=circle_colors[i], linewidth=1)
-    left_panel.add_patch(circle)
+# plot the circles in the left panel as one collection
+circles = [mplpatches.Circle((2 + 1*i, 8), 1) for i in range(len(circle_colors))]
+left_panel.add_collection(PatchCollection(circles, facecolors='none', edgecolors=circle_colors, linewidths=1))
 
 # define the right panel for the heatmap
 right_panel = figure.add_axes([0.35,0.1, 2/5, 1/2])  
@@ -50,19 +61,11 @@ right_panel.axis('off')
 
 # create horizontal gradients
 num_rectangles = 300  
-colors_viridis = plt.get_cmap('viridis')(np.linspace(0, 1, num_rectangles))
-colors_plasma = plt.get_cmap('plasma')(np.linspace(0, 1, num_rectangles))
 
-# draw gradient using multiple thin rectangles
+# draw each gradient as a single image
 rect_height = 0.5 
-for i in range(num_rectangles):
-    rect_x = i / num_rectangles * 2 
-    color_v = colors_viridis[i]
-    color_p = colors_plasma[i]
-    viridis_rect = mplpatches.Rectangle((rect_x, 0), 2/num_rectangles, rect_height, color=color_v, edgecolor='black', linewidth=1.5)
-    plasma_rect = mplpatches.Rectangle((rect_x, 0.5), 2/num_rectangles, rect_height, color=color_p, edgecolor='black', linewidth=1.5)
-    right_panel.add_patch(viridis_rect)
-    right_panel.add_patch(plasma_rect)
+plot_gradient(right_panel, 'viridis', num_rectangles, (0, 2, 0, rect_height))
+plot_gradient(right_panel, 'plasma', num_rectangles, (0, 2, 0.5, 0.5 + rect_height))
 
 # outline panels and rectangles black
 left_outline = mplpatches.Rectangle((0, 0), 1, 1, transform=left_panel.transAxes, fill=False, edgecolor='black', linewidth=1.5)
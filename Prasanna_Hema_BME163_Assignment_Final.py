@@ -1,8 +1,27 @@
 
 import matplotlib.pyplot as plt
-import matplotlib.patches as mplpatches
+from matplotlib.collections import PolyCollection
+from matplotlib.colors import LinearSegmentedColormap
 import numpy as np
 import argparse
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import heapq
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from typing import NamedTuple
+import bme163_io
+
+# read inputs in large chunks, which matters most on network storage
+BUFFER_SIZE = 1 << 22
+
+# bump whenever parsing changes what ends up in a cached region
+PARSER_VERSION = 1
 
 # Argument parsing
 def parse_args():
@@ -10,181 +29,474 @@ def parse_args():
     parser.add_argument('-p5', '--psl5', required=True, help='Path to BME163_Input_Data_5.psl file')
     parser.add_argument('-p6', '--psl6', required=True, help='Path to BME163_Input_Data_6.psl file')
     parser.add_argument('-g', '--gtf', required=True, help='Path to gencode.vM12.annotation.gtf file')
-    parser.add_argument('-c', '--coordinates', required=True, help='Coordinates in the format chr:start-end')
-    parser.add_argument('-o', '--output', required=True, help='Output file name')
+    regions = parser.add_mutually_exclusive_group(required=True)
+    regions.add_argument('-c', '--coordinates', help='Coordinates in the format chr:start-end')
+    regions.add_argument('-r', '--regions', help='BED file (chr start end [name]) or list of chr:start-end lines to plot in one batch')
+    parser.add_argument('-o', '--output', required=True, help='Output file name (output directory with --regions)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Worker processes for --regions')
+    parser.add_argument('-d', '--dpi', type=int, default=2400, help='Output resolution')
+    parser.add_argument('-l', '--lod_threshold', type=float, default=50, help='Bases per pixel above which read tracks are drawn as density images')
+    parser.add_argument('-a', '--aggregate', choices=['max', 'mean'], default='max', help='How coverage is reduced to one value per output pixel')
+    parser.add_argument('--cache_dir', help='Directory for cached parsed regions (disabled if not given)')
+    parser.add_argument('--cache_size', type=float, default=1024, help='Cache size limit in MB, least recently used regions are evicted first')
+    parser.add_argument('-x', '--index', action='store_true', help='Build (once) and query on-disk region indexes next to the inputs')
     return parser.parse_args()
 
 # Panel configuration
-def panel_edit(panel):
+def panel_edit(panel, start, end):
     panel.tick_params(bottom=False, labelbottom=False,
                       left=False, labelleft=False,
                       right=False, labelright=False,
                       top=False, labeltop=False)
     panel.axes.get_yaxis().set_ticks([])
     panel.axes.get_xaxis().set_ticks([])
-    panel.set_xlim(45232000, 45241000)
+    panel.set_xlim(start, end)
 
-# GTF file parsing
-def parse_gtf(gtf_file, chromosome, start, end):
-    transcripts = []
-    gtfdict = {}
-    for line in open(gtf_file):
+# size of a panel in output pixels
+def panel_pixels(panel, dpi):
+    return (max(1, int(panel.bbox.width / panel.figure.dpi * dpi)),
+            max(1, int(panel.bbox.height / panel.figure.dpi * dpi)))
+
+# block types for Alignments.block_types
+EXON, CDS = 0, 1
+
+# reads or transcripts as columns: one entry per record in chrom/starts/ends, and CSR-style
+# offsets so record i owns blocks block_offsets[i]:block_offsets[i + 1] of the flat block arrays
+class Alignments(NamedTuple):
+    chromosomes: np.ndarray    # chromosome names, indexed by chrom
+    chrom: np.ndarray          # int32 chromosome code per record
+    starts: np.ndarray         # int32
+    ends: np.ndarray           # int32
+    block_offsets: np.ndarray  # int64, one longer than the record count
+    block_starts: np.ndarray   # int32
+    block_sizes: np.ndarray    # int32
+    block_types: np.ndarray    # uint8, EXON or CDS
+
+# build Alignments from per-record and flat block sequences; chromosomes is one name per
+# record, or a single name shared by every record
+def make_alignments(chromosomes, starts, ends, block_counts, block_starts, block_sizes, block_types=None):
+    if isinstance(chromosomes, str):
+        names, chrom = np.array([chromosomes]), np.zeros(len(starts), dtype=np.int32)
+    else:
+        names, chrom = np.unique(np.array(chromosomes, dtype=str), return_inverse=True)
+    block_offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(block_counts, out=block_offsets[1:])
+    if block_types is None:
+        block_types = np.full(len(block_starts), EXON, dtype=np.uint8)
+    return Alignments(names, chrom.astype(np.int32), np.array(starts, dtype=np.int32), np.array(ends, dtype=np.int32),
+                      block_offsets, np.array(block_starts, dtype=np.int32), np.array(block_sizes, dtype=np.int32),
+                      np.array(block_types, dtype=np.uint8))
+
+# GTF exon/CDS parts as columns, in file order
+class GtfParts(NamedTuple):
+    chromosomes: np.ndarray    # chromosome names, indexed by chrom
+    chrom: np.ndarray          # int32 chromosome code per part
+    transcripts: np.ndarray    # transcript ids, indexed by transcript
+    transcript: np.ndarray     # int32 transcript code per part
+    starts: np.ndarray         # int32
+    ends: np.ndarray           # int32
+    types: np.ndarray          # uint8, EXON or CDS
+
+def make_gtf_parts(chromosomes, transcripts, starts, ends, types):
+    chromosome_names, chrom = np.unique(np.array(chromosomes, dtype=str), return_inverse=True)
+    transcript_ids, transcript = np.unique(np.array(transcripts, dtype=str), return_inverse=True)
+    return GtfParts(chromosome_names, chrom.astype(np.int32), transcript_ids, transcript.astype(np.int32),
+                    np.array(starts, dtype=np.int32), np.array(ends, dtype=np.int32), np.array(types, dtype=np.uint8))
+
+# parts lying fully inside [start, end], the same test the GTF parser applies
+def parts_in_region(parts, start, end):
+    inside = np.flatnonzero((parts.starts >= start) & (parts.ends <= end))
+    return parts._replace(chrom=parts.chrom[inside], transcript=parts.transcript[inside], starts=parts.starts[inside],
+                          ends=parts.ends[inside], types=parts.types[inside])
+
+# records at the given positions, in that order, with their blocks gathered alongside
+def take_alignments(alignments, index):
+    index = np.asarray(index, dtype=np.int64)
+    first = alignments.block_offsets[index]
+    counts = alignments.block_offsets[index + 1] - first
+    block_offsets = np.zeros(index.size + 1, dtype=np.int64)
+    np.cumsum(counts, out=block_offsets[1:])
+    blocks = np.repeat(first - block_offsets[:-1], counts) + np.arange(block_offsets[-1])
+    return alignments._replace(chrom=alignments.chrom[index], starts=alignments.starts[index],
+                               ends=alignments.ends[index], block_offsets=block_offsets,
+                               block_starts=alignments.block_starts[blocks], block_sizes=alignments.block_sizes[blocks],
+                               block_types=alignments.block_types[blocks])
+
+# one .npy per column, so a saved set can be memory-mapped back
+def save_alignments(alignments, directory):
+    os.makedirs(directory, exist_ok=True)
+    for field, values in zip(Alignments._fields, alignments):
+        np.save(os.path.join(directory, field + '.npy'), values)
+
+def load_alignments(directory, mmap_mode='r'):
+    return Alignments(*(np.load(os.path.join(directory, field + '.npy'), mmap_mode=mmap_mode)
+                        for field in Alignments._fields))
+
+# index directory for an input file, one set of .npy arrays per chromosome
+def index_path(data_file):
+    return data_file + '.idx'
+
+# size and modification time of an input, recorded in its index
+def source_identity(data_file):
+    stat = os.stat(data_file)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+# reuse an index only while the input has the size and mtime it was built from
+def index_is_current(data_file):
+    marker = os.path.join(index_path(data_file), 'source.npy')
+    return os.path.exists(marker) and np.array_equal(np.load(marker), source_identity(data_file))
+
+# write interval-sorted (start, end, file offset) records for each chromosome;
+# identity should be taken before the input was scanned
+def write_index(data_file, records, identity=None):
+    if identity is None:
+        identity = source_identity(data_file)
+    directory = index_path(data_file)
+    os.makedirs(directory, exist_ok=True)
+    marker = os.path.join(directory, 'source.npy')
+    if os.path.exists(marker):
+        os.remove(marker)
+    for chromosome, rows in records.items():
+        rows = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        rows = rows[np.lexsort((rows[:, 2], rows[:, 0]))]
+        np.save(os.path.join(directory, chromosome + '.starts.npy'), rows[:, 0])
+        np.save(os.path.join(directory, chromosome + '.ends.npy'), rows[:, 1])
+        np.save(os.path.join(directory, chromosome + '.max_ends.npy'), np.maximum.accumulate(rows[:, 1]))
+        np.save(os.path.join(directory, chromosome + '.offsets.npy'), rows[:, 2])
+    np.save(os.path.join(directory, 'chromosomes.npy'), np.array(sorted(records), dtype=str))
+    # written last so a half-built index is never treated as current
+    np.save(marker, identity)
+
+# file offsets of indexed records inside the window, in file order
+def query_index(data_file, chromosome, start, end, contained=False):
+    directory = index_path(data_file)
+    if chromosome not in np.load(os.path.join(directory, 'chromosomes.npy')):
+        return np.zeros(0, dtype=np.int64)
+    load = lambda name: np.load(os.path.join(directory, chromosome + '.' + name + '.npy'), mmap_mode='r')
+    starts, ends, max_ends, offsets = load('starts'), load('ends'), load('max_ends'), load('offsets')
+    if contained:
+        # records lying fully inside [start, end]
+        lo = np.searchsorted(starts, start, side='left')
+        hi = np.searchsorted(starts, end, side='right')
+        keep = ends[lo:hi] <= end
+    else:
+        # records with either end strictly inside (start, end)
+        lo = np.searchsorted(max_ends, start, side='right')
+        hi = np.searchsorted(starts, end, side='left')
+        s, e = starts[lo:hi], ends[lo:hi]
+        keep = ((start < s) & (s < end)) | ((start < e) & (e < end))
+    return np.sort(offsets[lo:hi][keep])
+
+# read the lines stored at the given offsets
+def read_lines_at(data_file, offsets):
+    with open(data_file, 'rb', buffering=BUFFER_SIZE) as file:
+        for offset in offsets:
+            file.seek(offset)
+            yield file.readline().decode()
+
+# one pass over the GTF recording where every exon/CDS line starts
+def build_gtf_index(gtf_file):
+    identity = source_identity(gtf_file)
+    records = {}
+    offset = 0
+    with open(gtf_file, 'rb', buffering=BUFFER_SIZE) as file:
+        for line in file:
+            if not line.startswith(b"#"):
+                split_list = line.split(b'\t', 5)
+                if len(split_list) > 4 and split_list[2] in (b"exon", b"CDS"):
+                    records.setdefault(split_list[0].decode(), []).append((int(split_list[3]), int(split_list[4]), offset))
+            offset += len(line)
+    write_index(gtf_file, records, identity)
+
+# indexed lines of an input that can fall inside the windows ({chromosome: (start, end)})
+def window_lines(data_file, windows, build_index, contained=False):
+    if not index_is_current(data_file):
+        build_index(data_file)
+    return (line for chromosome, (start, end) in windows.items()
+            for line in read_lines_at(data_file, query_index(data_file, chromosome, start, end, contained)))
+
+# exon/CDS parts inside each window, in file order: cut from one bulk read of the whole file, or
+# parsed from the indexed lines (gzipped inputs cannot be seeked by offset, so are always read whole)
+def parse_gtf_windows(gtf_file, windows, use_index=False):
+    if not use_index or bme163_io.is_gzip(gtf_file):
+        return split_gtf_windows(bme163_io.read_gtf(gtf_file, chromosomes=windows), windows)
+    columns = {chromosome: ([], [], [], []) for chromosome in windows}
+    for line in window_lines(gtf_file, windows, build_gtf_index, contained=True):
         if line.startswith("#"):
             continue
         split_list = line.strip().split('\t')
-        if split_list[0] == chromosome and int(split_list[3]) >= start and int(split_list[4]) <= end:
+        if split_list[0] not in windows:
+            continue
+        start, end = windows[split_list[0]]
+        if int(split_list[3]) >= start and int(split_list[4]) <= end:
             feature_type = split_list[2]
             if feature_type == "exon" or feature_type == "CDS":
-                transcript = split_list[8].split('transcript_id "')[1].split('"')[0]
-                if transcript not in gtfdict:
-                    gtfdict[transcript] = []
-                gtfdict[transcript].append([split_list[0], int(split_list[3]), int(split_list[4]), feature_type])
-    
-    for transcript, parts in gtfdict.items():
-        starts = []
-        ends = []
-        block_starts = []
-        block_widths = []
-        types = []
-        for part in parts:
-            starts.append(part[1])
-            ends.append(part[2])
-            block_starts.append(part[1])
-            block_widths.append(part[2] - part[1])
-            types.append(part[3])
-        transcripts.append([parts[0][0], min(starts), max(ends), block_starts, block_widths, False, types])
-    return sorted(transcripts, key=lambda x: x[2])
-
-# PSL file parsing
-def parse_psl(psl_file, chromosome, start, end):
-    reads = []
-    with open(psl_file) as file:
+                transcripts, starts, ends, types = columns[split_list[0]]
+                transcripts.append(split_list[8].split('transcript_id "')[1].split('"')[0])
+                starts.append(int(split_list[3]))
+                ends.append(int(split_list[4]))
+                types.append(CDS if feature_type == "CDS" else EXON)
+    return {chromosome: make_gtf_parts([chromosome] * len(starts), transcripts, starts, ends, types)
+            for chromosome, (transcripts, starts, ends, types) in columns.items()}
+
+# parts lying fully inside each window, from bulk-read GTF records
+def split_gtf_windows(records, windows):
+    parts = {}
+    for chromosome, (start, end) in windows.items():
+        inside = ((records.chromosomes == chromosome.encode()) & (records.starts >= start) & (records.ends <= end))
+        parts[chromosome] = make_gtf_parts([chromosome] * int(inside.sum()), records.transcripts[inside].astype(str),
+                                           records.starts[inside], records.ends[inside],
+                                           np.where(records.features[inside] == b"CDS", CDS, EXON))
+    return parts
+
+def parse_gtf_parts(gtf_file, chromosome, start, end, use_index=False):
+    return parse_gtf_windows(gtf_file, {chromosome: (start, end)}, use_index)[chromosome]
+
+# group parts into transcripts sorted by end; transcripts are taken in order of first
+# appearance and keep their parts in file order
+def group_transcripts(parts):
+    part_count = parts.starts.size
+    position = np.arange(part_count)
+    first_seen = np.full(parts.transcripts.size, part_count)
+    np.minimum.at(first_seen, parts.transcript, position)
+    order = np.lexsort((position, first_seen[parts.transcript]))
+    transcript = parts.transcript[order]
+    heads = np.flatnonzero(np.concatenate([[True], transcript[1:] != transcript[:-1]])) if part_count else position
+    starts, ends = parts.starts[order], parts.ends[order]
+
+    transcripts = make_alignments(parts.chromosomes[parts.chrom[order][heads]],
+                                  np.minimum.reduceat(starts, heads) if part_count else [],
+                                  np.maximum.reduceat(ends, heads) if part_count else [],
+                                  np.diff(np.append(heads, part_count)), starts, ends - starts, parts.types[order])
+    return take_alignments(transcripts, np.argsort(transcripts.ends, kind='stable'))
+
+# GTF file parsing
+def parse_gtf(gtf_file, chromosome, start, end, use_index=False):
+    return group_transcripts(parse_gtf_parts(gtf_file, chromosome, start, end, use_index))
+
+# one pass over the PSL recording where every alignment starts, keyed by (tName, tStart)
+def build_psl_index(psl_file):
+    identity = source_identity(psl_file)
+    records = {}
+    offset = 0
+    with open(psl_file, 'rb', buffering=BUFFER_SIZE) as file:
         for line in file:
-            if line.startswith("start"):
-                continue
-            fields = line.strip().split("\t")
-            if len(fields) < 21:
-                continue
-            try:
-                block_sizes = list(map(int, fields[18].rstrip(',').split(',')))
-                block_starts = list(map(int, fields[20].rstrip(',').split(',')))
-                read = [fields[13], int(fields[15]), int(fields[16]), block_starts, block_sizes, False]
-                if fields[13] == chromosome and (start < int(fields[15]) < end or start < int(fields[16]) < end):
-                    reads.append(read)
-            except ValueError:
-                continue
+            fields = line.split(b"\t", 17)
+            if not line.startswith(b"start") and len(fields) > 17:
+                try:
+                    records.setdefault(fields[13].decode(), []).append((int(fields[15]), int(fields[16]), offset))
+                except ValueError:
+                    pass
+            offset += len(line)
+    write_index(psl_file, records, identity)
+
+# PSL file parsing: reads overlapping each window ({chromosome: (start, end)}), cut from one bulk
+# read of the whole file or parsed from the indexed lines
+def parse_psl_windows(psl_file, windows, use_index=False):
+    if not use_index or bme163_io.is_gzip(psl_file):
+        return split_psl_windows(bme163_io.read_psl(psl_file, windows=windows), windows)
+    # typed int32 buffers, so parsing never holds a Python int per read or block
+    columns = {chromosome: tuple(array('i') for _ in range(5)) for chromosome in windows}
+    for line in window_lines(psl_file, windows, build_psl_index):
+        if line.startswith("start"):
+            continue
+        fields = line.strip().split("\t")
+        if len(fields) < 21 or fields[13] not in windows:
+            continue
+        start, end = windows[fields[13]]
+        try:
+            read_start, read_end = int(fields[15]), int(fields[16])
+            # only decode block lists for alignments inside the window
+            if start < read_start < end or start < read_end < end:
+                read_sizes = list(map(int, fields[18].rstrip(',').split(',')))
+                read_starts = list(map(int, fields[20].rstrip(',').split(',')))
+                count = min(len(read_sizes), len(read_starts))
+                starts, ends, counts, block_starts, block_sizes = columns[fields[13]]
+                starts.append(read_start)
+                ends.append(read_end)
+                counts.append(count)
+                block_starts.extend(read_starts[:count])
+                block_sizes.extend(read_sizes[:count])
+        except (ValueError, OverflowError):
+            continue
+    return {chromosome: make_alignments(chromosome, starts, ends, counts, block_starts, block_sizes)
+            for chromosome, (starts, ends, counts, block_starts, block_sizes) in columns.items()}
+
+# reads overlapping each window, from bulk-read PSL records, with their blocks gathered alongside
+def split_psl_windows(records, windows):
+    reads = {}
+    for chromosome, (start, end) in windows.items():
+        inside = np.flatnonzero((records.names == chromosome.encode()) &
+                                (((start < records.starts) & (records.starts < end)) | ((start < records.ends) & (records.ends < end))))
+        first = records.block_offsets[inside]
+        counts = records.block_offsets[inside + 1] - first
+        blocks = np.repeat(first - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        reads[chromosome] = make_alignments(chromosome, records.starts[inside], records.ends[inside], counts,
+                                            records.block_starts[blocks], records.block_sizes[blocks])
     return reads
 
-# function to stack reads
-def stack_reads(reads):
-    stacked_reads = []
-    for read in reads:
-        placed = False
-        for stack in stacked_reads:
-            if read[1] > stack[-1][2]: 
-                stack.append(read)
-                placed = True
-                break
-        if not placed:
-            stacked_reads.append([read])
-    return stacked_reads
+def parse_psl(psl_file, chromosome, start, end, use_index=False):
+    return parse_psl_windows(psl_file, {chromosome: (start, end)}, use_index)[chromosome]
+
+# function to stack reads: row index for each read, first fit in the given order
+# (a read goes on the lowest row whose last read ends more than min_gap before it starts)
+def stack_reads(starts, ends, min_gap=0):
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64) + min_gap
+    rows = np.zeros(len(starts), dtype=np.int32)
+    if np.all(starts[1:] >= starts[:-1]):
+        # sorted by start: once a row frees up it stays free, so keep busy rows in a
+        # min-heap of end positions and hand out freed rows lowest index first
+        busy, free = [], []
+        for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+            while busy and busy[0][0] < start:
+                heapq.heappush(free, heapq.heappop(busy)[1])
+            row = heapq.heappop(free) if free else len(busy)
+            heapq.heappush(busy, (end, row))
+            rows[i] = row
+        return rows
+    # any other order: segment tree holding the minimum row end over each range of rows,
+    # walked down to the leftmost row that ends before the read starts
+    size = 1
+    while size < len(starts):
+        size *= 2
+    tree = [float('inf')] * (2 * size)
+    row_count = 0
+    for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        if tree[1] < start:
+            node = 1
+            while node < size:
+                node = 2 * node if tree[2 * node] < start else 2 * node + 1
+            row = node - size
+        else:
+            row = row_count
+            row_count += 1
+        node = row + size
+        tree[node] = end
+        node //= 2
+        while node:
+            tree[node] = min(tree[2 * node], tree[2 * node + 1])
+            node //= 2
+        rows[i] = row
+    return rows
+
+# read order for plotting: sort by 'start' or 'end', stack, then lay out stack by stack
+# in placement order within each stack
+def stacked_order(starts, ends, sort_by='start'):
+    order = np.argsort(starts if sort_by == 'start' else ends, kind='stable')
+    rows = stack_reads(starts[order], ends[order])
+    return order[np.argsort(rows, kind='stable')]
+
+# draw a batch of rectangles as a single collection
+def add_rectangles(panel, x, y, width, height, **kwargs):
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    x1, y1 = x + width, y + height
+    vertices = np.stack([np.column_stack([x, y]), np.column_stack([x1, y]),
+                         np.column_stack([x1, y1]), np.column_stack([x, y1])], axis=1)
+    panel.add_collection(PolyCollection(vertices, **kwargs), autolim=False)
+
+# block starts, widths and row positions, given one row position per record
+def flatten_blocks(alignments, y_positions):
+    block_y = np.repeat(y_positions, np.diff(alignments.block_offsets))
+    return alignments.block_starts.astype(float), alignments.block_sizes.astype(float), block_y
 
 # flot transcripts
 def plot_transcripts(panel, transcripts):
-    y_pos = 0
-    y_increment = 1  
-    for transcript in transcripts:
-       
-        rectangle = mplpatches.Rectangle((transcript[1], y_pos + 0.23), transcript[2] - transcript[1], 0.05, facecolor='grey', edgecolor='black', linewidth=0.25)
-        panel.add_patch(rectangle)
-        
-        for i, block_start in enumerate(transcript[3]):
-            height = 0.5 if transcript[6][i] == "CDS" else 0.25
-            rectangle = mplpatches.Rectangle((block_start, y_pos), transcript[4][i], height, facecolor='grey', edgecolor='black', linewidth=0.25)
-            panel.add_patch(rectangle)
-        y_pos += y_increment
-    panel.set_ylim(0, y_pos + 1)
-
-# plot reads for the middle panel (sorted by end)
-def plot_reads_sorted_by_end(panel, reads, color):
-    y_pos = 0
-    y_increment = 1  
-    stacked_reads = stack_reads(sorted(reads, key=lambda x: x[2]))
-    for stack in stacked_reads:
-        for read in stack:
-           
-            rectangle = mplpatches.Rectangle((read[1], y_pos + 0.18), read[2] - read[1], 0.05, facecolor=color, edgecolor=color, linewidth=0)
-            panel.add_patch(rectangle)
-            
-            for block_start, block_width in zip(read[3], read[4]):
-                rectangle = mplpatches.Rectangle((block_start, y_pos), block_width, 0.5, facecolor=color, edgecolor=color, linewidth=0)
-                panel.add_patch(rectangle)
-            y_pos += y_increment
-    panel.set_ylim(0, y_pos + 1)
-
-# plot reads for the bottom panel (sorted by start)
-def plot_reads_sorted_by_start(panel, reads, color):
-    y_pos = 0
-    y_increment = 1  
-    stacked_reads = stack_reads(sorted(reads, key=lambda x: x[1]))
-    for stack in stacked_reads:
-        for read in stack:
-            
-            rectangle = mplpatches.Rectangle((read[1], y_pos + 0.18), read[2] - read[1], 0.05, facecolor=color, edgecolor=color, linewidth=0)
-            panel.add_patch(rectangle)
-            
-            for block_start, block_width in zip(read[3], read[4]):
-                rectangle = mplpatches.Rectangle((block_start, y_pos), block_width, 0.5, facecolor=color, edgecolor=color, linewidth=0)
-                panel.add_patch(rectangle)
-            y_pos += y_increment
-    panel.set_ylim(0, y_pos + 1)
-
-# plot reads for the condensed panel (sorted by start)
-def plot_reads_sorted_by_start_condensed(panel, reads, color):
-    y_pos = 0
-    y_increment = 0.2  
-    stacked_reads = stack_reads(sorted(reads, key=lambda x: x[1]))
-    for stack in stacked_reads:
-        for read in stack:
-            
-            rectangle = mplpatches.Rectangle((read[1], y_pos + 0.18), read[2] - read[1], 0.05, facecolor=color, edgecolor=color, linewidth=0)
-            panel.add_patch(rectangle)
-            
-            for block_start, block_width in zip(read[3], read[4]):
-                rectangle = mplpatches.Rectangle((block_start, y_pos), block_width, 0.5, facecolor=color, edgecolor=color, linewidth=0)
-                panel.add_patch(rectangle)
-            y_pos += y_increment
-    panel.set_ylim(0, y_pos * 1.10)  
-
-# histogram for the bottom panel
-def plot_histogram(panel, reads, start, end):
-    coverage = np.zeros(end - start)
-    for read in reads:
-        for block_start, block_width in zip(read[3], read[4]):
-            coverage[block_start - start:block_start - start + block_width] += 1
-    panel.bar(range(start, end), coverage, width=1.0, color=(88/255, 85/255, 120/255), edgecolor='none')
-    panel.set_ylim(max(coverage) + 1, 0)  
+    y_pos = np.arange(transcripts.starts.size, dtype=float)
+    starts = transcripts.starts.astype(float)
+    ends = transcripts.ends.astype(float)
+    style = dict(facecolor='grey', edgecolor='black', linewidth=0.25)
+    add_rectangles(panel, starts, y_pos + 0.23, ends - starts, 0.05, **style)
+
+    block_starts, block_widths, block_y = flatten_blocks(transcripts, y_pos)
+    is_cds = transcripts.block_types == CDS
+    add_rectangles(panel, block_starts[~is_cds], block_y[~is_cds], block_widths[~is_cds], 0.25, **style)
+    add_rectangles(panel, block_starts[is_cds], block_y[is_cds], block_widths[is_cds], 0.5, **style)
+    panel.set_ylim(0, transcripts.starts.size + 1)
+
+# level-of-detail read track: block coverage binned onto the panel's pixel grid, drawn as one image
+def plot_read_density(panel, block_starts, block_widths, block_y, y_max, color, dpi):
+    start, end = panel.get_xlim()
+    columns, rows = panel_pixels(panel, dpi)
+    row = np.minimum((block_y / y_max * rows).astype(np.int64), rows - 1)
+    first = np.clip(np.floor((block_starts - start) / (end - start) * columns), 0, columns).astype(np.int64)
+    last = np.clip(np.ceil((block_starts + block_widths - start) / (end - start) * columns), 0, columns).astype(np.int64)
+    last = np.maximum(last, np.minimum(first + 1, columns))
+    # +1/-1 at the first/past-last pixel of every block, cumsum along each pixel row
+    density = np.zeros((rows, columns + 1), dtype=np.int32)
+    np.add.at(density, (row, first), 1)
+    np.add.at(density, (row, last), -1)
+    np.cumsum(density, axis=1, out=density)
+    density = density[:, :-1]
+    # saturate at the 99th percentile so a few packed pixels don't wash out the rest
+    covered = density[density > 0]
+    vmax = max(1, np.percentile(covered, 99)) if covered.size else 1
+    cmap = LinearSegmentedColormap.from_list('density', [(*color, 0), (*color, 1)])
+    panel.imshow(density, extent=(start, end, 0, y_max), origin='lower', aspect='auto',
+                 interpolation='nearest', cmap=cmap, vmin=0, vmax=vmax)
+
+# plot stacked reads, sorted by 'start' or 'end'; condensed rows overlap for deep panels
+def plot_reads(panel, reads, color, sort_by='start', condensed=False, dpi=2400, lod_threshold=50):
+    reads = take_alignments(reads, stacked_order(reads.starts, reads.ends, sort_by))
+    read_count = reads.starts.size
+    y_increment = 0.2 if condensed else 1
+    y_pos = np.arange(read_count) * y_increment
+    if condensed:
+        y_max = read_count * y_increment * 1.10
+    else:
+        y_max = read_count * y_increment + 1
+    block_starts, block_widths, block_y = flatten_blocks(reads, y_pos)
+
+    start, end = panel.get_xlim()
+    if read_count and (end - start) / panel_pixels(panel, dpi)[0] > lod_threshold:
+        plot_read_density(panel, block_starts, block_widths, block_y, y_max, color, dpi)
+    else:
+        starts = reads.starts.astype(float)
+        ends = reads.ends.astype(float)
+        style = dict(facecolor=color, edgecolor=color, linewidth=0)
+        add_rectangles(panel, starts, y_pos + 0.18, ends - starts, 0.05, **style)
+        add_rectangles(panel, block_starts, block_y, block_widths, 0.5, **style)
+    panel.set_ylim(0, y_max)
+
+# per-base coverage over [start, end): +1 at every block start, -1 at every block end, then cumsum
+def calculate_coverage(reads, start, end):
+    block_starts = reads.block_starts.astype(np.int64) - start
+    block_ends = block_starts + reads.block_sizes
+    size = end - start
+    steps = (np.bincount(np.clip(block_starts, 0, size), minlength=size + 1)
+             - np.bincount(np.clip(block_ends, 0, size), minlength=size + 1))
+    return np.cumsum(steps[:size])
+
+# reduce coverage to at most `bins` values by max or mean, returning values and bin edges
+def downsample_coverage(coverage, bins, aggregate='max'):
+    if bins >= len(coverage):
+        return coverage, np.arange(len(coverage) + 1)
+    edges = np.linspace(0, len(coverage), bins + 1).astype(np.int64)
+    if aggregate == 'max':
+        return np.maximum.reduceat(coverage, edges[:-1]), edges
+    return np.add.reduceat(coverage, edges[:-1]) / np.diff(edges), edges
+
+# histogram for the bottom panel, one value per output pixel drawn as a single step artist
+def plot_histogram(panel, coverage, start, end, dpi=2400, aggregate='max'):
+    pixels = panel_pixels(panel, dpi)[0]
+    values, edges = downsample_coverage(coverage, pixels, aggregate)
+    panel.stairs(values, start + edges, fill=True, color=(88/255, 85/255, 120/255), linewidth=0)
+    panel.set_ylim(coverage.max(initial=0) + 1, 0)
     panel.set_xlim(start, end)
 
    
     panel.set_yticks([])
     panel.set_xticks([])
 
-# main function
-def main():
-    args = parse_args()
-    chromosome, region = args.coordinates.split(':')
-    start, end = map(int, region.split('-'))
-
-    # parse files
-    gtf_data = parse_gtf(args.gtf, chromosome, start, end)
-    psl5_data = parse_psl(args.psl5, chromosome, start, end)
-    psl6_data = parse_psl(args.psl6, chromosome, start, end)
-
-    # filter reads
-    filtered_psl5_data = [read for read in psl5_data if read[0] == chromosome and (start < read[1] < end or start < read[2] < end)]
-    filtered_psl6_data = [read for read in psl6_data if read[0] == chromosome and (start < read[1] < end or start < read[2] < end)]
+# everything drawn for one region
+class RegionData(NamedTuple):
+    transcripts: Alignments
+    psl5: Alignments
+    psl6: Alignments
+    coverage: np.ndarray
 
+# draw the 4-panel locus figure for one region
+def render_region(region, start, end, output, dpi=2400, lod_threshold=50, aggregate='max'):
     # create figure
     plt.figure(figsize=(5, 6))
 
@@ -195,22 +507,179 @@ def main():
     panel3 = plt.axes([0.1/5, 0.1/6, 4/5, 0.4/6])
 
     # edit panels
-    panel_edit(panel0)
-    panel_edit(panel1)
-    panel_edit(panel2)
-    panel_edit(panel3)
+    panel_edit(panel0, start, end)
+    panel_edit(panel1, start, end)
+    panel_edit(panel2, start, end)
+    panel_edit(panel3, start, end)
 
     # plot data
-    plot_transcripts(panel0, gtf_data)  # grey plot
-    plot_reads_sorted_by_end(panel1, filtered_psl5_data, (230/255, 87/255, 43/255))  # orange plot
-    plot_reads_sorted_by_start_condensed(panel2, filtered_psl6_data, (88/255, 85/255, 120/255))  # blue plot
-    plot_histogram(panel3, filtered_psl6_data, start, end)  # coverage histogram
+    plot_transcripts(panel0, region.transcripts)  # grey plot
+    plot_reads(panel1, region.psl5, (230/255, 87/255, 43/255), sort_by='end', dpi=dpi, lod_threshold=lod_threshold)  # orange plot
+    plot_reads(panel2, region.psl6, (88/255, 85/255, 120/255), condensed=True, dpi=dpi, lod_threshold=lod_threshold)  # blue plot
+    plot_histogram(panel3, region.coverage, start, end, dpi=dpi, aggregate=aggregate)  # coverage histogram
 
     
-    plt.savefig(args.output, dpi=2400)
+    plt.savefig(output, dpi=dpi)
     plt.close()
 
-if __name__ == "__main__":
-    main()
+# parse chr:start-end
+def parse_coordinates(coordinates):
+    chromosome, region = coordinates.split(':')
+    start, end = map(int, region.split('-'))
+    return chromosome, start, end
+
+# regions for batch mode as (name, chromosome, start, end), from BED or chr:start-end lines
+def read_regions(regions_file):
+    regions = []
+    for line in open(regions_file):
+        if not line.strip() or line.startswith(("#", "track", "browser")):
+            continue
+        fields = line.split()
+        if ':' in fields[0]:
+            chromosome, start, end = parse_coordinates(fields[0])
+            name = fields[1] if len(fields) > 1 else None
+        else:
+            chromosome, start, end = fields[0], int(fields[1]), int(fields[2])
+            name = fields[3] if len(fields) > 3 else None
+        regions.append((name or f'{chromosome}_{start}_{end}', chromosome, start, end))
+    return regions
+
+# parsed inputs for one window: GTF exon/CDS parts and the reads of both PSLs
+class LocusInputs(NamedTuple):
+    gtf_parts: GtfParts
+    psl5: Alignments
+    psl6: Alignments
 
+# load the GTF and both PSLs for every window ({chromosome: (start, end)}) concurrently, one
+# pass per file, so wall time follows the slowest file
+def load_inputs(args, windows):
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        gtf_parts = executor.submit(parse_gtf_windows, args.gtf, windows, args.index)
+        psl5 = executor.submit(parse_psl_windows, args.psl5, windows, args.index)
+        psl6 = executor.submit(parse_psl_windows, args.psl6, windows, args.index)
+        gtf_parts, psl5, psl6 = gtf_parts.result(), psl5.result(), psl6.result()
+    return {chromosome: LocusInputs(gtf_parts[chromosome], psl5[chromosome], psl6[chromosome])
+            for chromosome in windows}
 
+# parse every input once, with one window per chromosome spanning all of its regions
+def load_batch(args, regions):
+    windows = {}
+    for name, chromosome, start, end in regions:
+        span_start, span_end = windows.get(chromosome, (start, end))
+        windows[chromosome] = (min(span_start, start), max(span_end, end))
+    return load_inputs(args, windows)
+
+# same overlap test parse_psl applies, for cutting a region out of a wider load
+def reads_in_region(reads, start, end):
+    inside = ((start < reads.starts) & (reads.starts < end)) | ((start < reads.ends) & (reads.ends < end))
+    return take_alignments(reads, np.flatnonzero(inside))
+
+# decoded inputs shared with batch workers (inherited on fork, sent once per worker otherwise)
+batch_data = {}
+
+def init_batch_worker(loaded):
+    batch_data.update(loaded)
+
+def render_batch_region(job):
+    (name, chromosome, start, end), output, dpi, lod_threshold, aggregate = job
+    began = time.perf_counter()
+    gtf_parts, psl5_data, psl6_data = batch_data[chromosome]
+    psl6_region = reads_in_region(psl6_data, start, end)
+    region = RegionData(group_transcripts(parts_in_region(gtf_parts, start, end)), reads_in_region(psl5_data, start, end),
+                        psl6_region, calculate_coverage(psl6_region, start, end))
+    render_region(region, start, end, output, dpi, lod_threshold, aggregate)
+    return name, chromosome, start, end, time.perf_counter() - began
+
+# render every region in the regions file across a process pool
+def run_batch(args):
+    regions = read_regions(args.regions)
+    os.makedirs(args.output, exist_ok=True)
+    began = time.perf_counter()
+    loaded = load_batch(args, regions)
+    print(f'parsed inputs for {len(regions)} regions in {time.perf_counter() - began:.2f}s')
+
+    jobs = [(region, os.path.join(args.output, region[0] + '.png'), args.dpi, args.lod_threshold, args.aggregate) for region in regions]
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    with context.Pool(max(1, min(args.jobs, len(jobs))), initializer=init_batch_worker, initargs=(loaded,)) as pool:
+        # imap keeps results in input order whatever order workers finish in
+        for name, chromosome, start, end, seconds in pool.imap(render_batch_region, jobs):
+            print(f'{name}\t{chromosome}:{start}-{end}\t{seconds:.2f}s')
+    print(f'rendered {len(jobs)} regions in {time.perf_counter() - began:.2f}s')
+
+# cache key: identity of every input file, the region and the parser version
+def region_cache_key(args, chromosome, start, end):
+    files = [[os.path.abspath(path), os.stat(path).st_size, os.stat(path).st_mtime_ns]
+             for path in (args.gtf, args.psl5, args.psl6)]
+    key = json.dumps([PARSER_VERSION, files, chromosome, start, end])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+# memory-mapped region from the cache, or None on a miss
+def read_region_cache(cache_dir, key):
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return None
+    # mark as recently used for eviction
+    os.utime(entry)
+    return RegionData(load_alignments(os.path.join(entry, 'transcripts')),
+                      load_alignments(os.path.join(entry, 'psl5')),
+                      load_alignments(os.path.join(entry, 'psl6')),
+                      np.load(os.path.join(entry, 'coverage.npy'), mmap_mode='r'))
+
+# store a region, then evict least recently used entries until the cache fits in max_bytes
+def write_region_cache(cache_dir, key, region, max_bytes):
+    os.makedirs(cache_dir, exist_ok=True)
+    # build the entry under a temporary name so readers never see a partial one
+    staging = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    save_alignments(region.transcripts, os.path.join(staging, 'transcripts'))
+    save_alignments(region.psl5, os.path.join(staging, 'psl5'))
+    save_alignments(region.psl6, os.path.join(staging, 'psl6'))
+    np.save(os.path.join(staging, 'coverage.npy'), region.coverage)
+    try:
+        os.rename(staging, os.path.join(cache_dir, key))
+    except OSError:
+        # another run stored the same region first
+        shutil.rmtree(staging, ignore_errors=True)
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if name.startswith('.') or not os.path.isdir(entry):
+            continue
+        size = sum(os.path.getsize(os.path.join(folder, file)) for folder, _, files in os.walk(entry) for file in files)
+        entries.append((os.path.getmtime(entry), size, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+# transcripts, reads and coverage for one region, from the cache when the inputs are unchanged
+def load_region(args, chromosome, start, end):
+    if args.cache_dir:
+        key = region_cache_key(args, chromosome, start, end)
+        region = read_region_cache(args.cache_dir, key)
+        if region is not None:
+            return region
+    # parse files (parse_psl already keeps only reads overlapping the window)
+    inputs = load_inputs(args, {chromosome: (start, end)})[chromosome]
+    region = RegionData(group_transcripts(inputs.gtf_parts), inputs.psl5, inputs.psl6,
+                        calculate_coverage(inputs.psl6, start, end))
+    if args.cache_dir:
+        write_region_cache(args.cache_dir, key, region, args.cache_size * 1e6)
+    return region
+
+# main function
+def main():
+    args = parse_args()
+    if args.regions:
+        run_batch(args)
+        return
+    chromosome, start, end = parse_coordinates(args.coordinates)
+
+    region = load_region(args, chromosome, start, end)
+    render_region(region, start, end, args.output, args.dpi, args.lod_threshold, args.aggregate)
+
+if __name__ == "__main__":
+    main()
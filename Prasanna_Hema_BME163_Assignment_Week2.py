@@ -56,66 +56,170 @@ plt.savefig(args.outputFile, dpi=600)
 import matplotlib.pyplot as plt
 import numpy as np
 import argparse
-import matplotlib.patches as mplpatches
+import matplotlib.colors as mcolors
+from matplotlib.collections import PolyCollection
+import tempfile
+import bme163_io
 
 # Function to calculate log2(values + 1)
 def log_transform(values):
     return np.log2(np.array(values) + 1)
 
-# Argument parser for input and output files
-parser = argparse.ArgumentParser()
-parser.add_argument('-i', '--inputFile', type=str, help='Input file path')
-parser.add_argument('-o', '--outputFile', type=str, help='Output file path')
-args = parser.parse_args()
-
-# Set the style for the plot
-plt.style.use('BME163')
-
-# Read the data from the input file and transform
-data = np.loadtxt(args.inputFile, usecols=(1, 2), skiprows=1)
-x_values = log_transform(data[:, 0])
-y_values = log_transform(data[:, 1])
-
-# Define the colors
-iBlue = (88/255, 85/255, 120/255)
-Grey = 'grey'
-iGreen = (120/255, 172/255, 145/255)
-
-# Create the figure and axes
-figure = plt.figure(figsize=(3, 3))
-main_panel = figure.add_axes([0.2, 0.2, 1.5/3, 1.5/3])  # Main scatter plot
-
-# Histograms (transformed using log)
-x_hist, x_bins = np.histogram(x_values, bins=50)
-y_hist, y_bins = np.histogram(y_values, bins=50)
-x_hist = log_transform(x_hist)
-y_hist = log_transform(y_hist)
-x_hist_norm = x_hist / max(x_hist) * (1.5/3)
-y_hist_norm = y_hist / max(y_hist) * (1.5/3)
-
-# Histogram axes
-left_panel = figure.add_axes([0.1, 0.2, 0.08, 1.5/3], sharey=main_panel)  # Left histogram
-top_panel = figure.add_axes([0.2, 0.72, 1.5/3, 0.08], sharex=main_panel)  # Top histogram
-
+# Function to read columns 1 and 2 of a whitespace-separated table in fixed-size byte chunks,
+# split in bulk and converted by numpy, yielding log2(values + 1) as an (n, 2) array per chunk
+def read_chunks(file_path, chunk_bytes=1 << 22):
+    for fields in bme163_io.iter_table(file_path, columns=[1, 2], header=True, chunk_bytes=chunk_bytes):
+        if len(fields):
+            yield log_transform(fields.astype(float))
+
+# Function to parse the table once, spilling the transformed values to a binary file and keeping
+# the running min and max of each column; returns the spilled values memory-mapped
+def spill_values(file_path, spill):
+    count, low, high = 0, np.full(2, np.inf), np.full(2, -np.inf)
+    for values in read_chunks(file_path):
+        values.tofile(spill)
+        count += len(values)
+        low, high = np.minimum(low, values.min(axis=0)), np.maximum(high, values.max(axis=0))
+    spill.flush()
+    return np.memmap(spill, dtype=float, mode='r', shape=(count, 2)), low, high
+
+# Function to walk the spilled values in fixed-size row blocks
+def value_chunks(values, rows=1 << 20):
+    for start in range(0, len(values), rows):
+        yield np.asarray(values[start:start + rows])
+
+# Function to find the output pixel (row * width + column) of each point
+def pixel_index(values, xlim, ylim, width_px, height_px):
+    column = np.clip(((values[:, 0] - xlim[0]) / (xlim[1] - xlim[0]) * width_px).astype(int), 0, width_px - 1)
+    row = np.clip(((values[:, 1] - ylim[0]) / (ylim[1] - ylim[0]) * height_px).astype(int), 0, height_px - 1)
+    return row * width_px + column
+
+# Function to draw histogram bars as one collection; 'vertical' bars grow up from the x axis,
+# 'horizontal' bars grow right from the y axis; the bars leave the panel's 0-1 extent as it was
+def plot_bars(panel, edges, heights, color, orientation='vertical'):
+    low, high, zero = edges[:-1], edges[1:], np.zeros_like(heights)
+    along = np.stack([low, low, high, high], axis=1)
+    across = np.stack([zero, heights, heights, zero], axis=1)
+    corners = np.stack([along, across] if orientation == 'vertical' else [across, along], axis=2)
+    panel.add_collection(PolyCollection(corners, facecolors=color, edgecolors='black', linewidths=0.2), autolim=False)
+
+# Function to spread each bin's count over a marker-sized disk, so every pixel holds the
+# number of markers that would cover it
+def marker_footprint(counts, radius_px):
+    r = int(np.ceil(radius_px))
+    offsets = np.arange(-r, r + 1)
+    disk = (offsets[:, None]**2 + offsets[None, :]**2 <= radius_px**2).astype(float)
+    shape = (counts.shape[0] + 2 * r, counts.shape[1] + 2 * r)
+    covered = np.fft.irfft2(np.fft.rfft2(counts, shape) * np.fft.rfft2(disk, shape), shape)
+    return np.rint(covered[r:r + counts.shape[0], r:r + counts.shape[1]])
+
+# Function to draw per-pixel marker coverage as one RGBA image; 'alpha' reproduces stacking
+# markers of the given alpha, the others scale opacity with the coverage
+def plot_density(panel, covered, xlim, ylim, color, transfer='alpha', alpha=0.1):
+    peak = max(covered.max(), 1)
+    opacity = {'alpha': lambda n: 1 - (1 - alpha)**n,
+               'linear': lambda n: n / peak,
+               'sqrt': lambda n: np.sqrt(n / peak),
+               'log': lambda n: np.log1p(n) / np.log1p(peak)}[transfer](covered)
+    image = np.zeros(covered.shape + (4,))
+    image[..., :3] = mcolors.to_rgb(color)
+    image[..., 3] = opacity
+    panel.imshow(image, extent=(*xlim, *ylim), origin='lower', aspect='auto', interpolation='nearest')
 
-# plot the scatterplot
-main_panel.scatter(x_values, y_values, s=10, color=iBlue, alpha=0.1, edgecolor='none')
-
-# Plot histograms using bar patches
-for i in range(len(x_bins)-1):
-    height=x_hist_norm[i] * 0.5
-    top_panel.add_patch(mplpatches.Rectangle((x_bins[i], 0), x_bins[i+1] - x_bins[i], x_hist_norm[i], height,
-                                facecolor=iGreen, edgecolor= 'black',linewidth=0.2))
-   #top_panel.add_patch(plt.Rectangle((x_bins[i], 0), x_bins[i+1] - x_bins[i], x_hist[i], facecolor=Grey, edgecolor=Grey))
-for i in range(len(y_bins)-1):
-    left_panel.add_patch(mplpatches.Rectangle((0, y_bins[i]), y_hist_norm[i], y_bins[i+1] - y_bins[i], height,
-                                facecolor=Grey, edgecolor='black',linewidth=0.2))
-
-# Set limits for the panels
-main_panel.set_xlim(0, max(x_values))
-main_panel.set_ylim(0, max(y_values))
-top_panel.set_xlim(main_panel.get_xlim())
-left_panel.set_ylim(main_panel.get_ylim())
-
-# save the figure
-plt.savefig(args.outputFile, dpi=600)
+# Argument parser for input and output files
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--inputFile', type=str, help='Input file path')
+    parser.add_argument('-o', '--outputFile', type=str, help='Output file path')
+    parser.add_argument('-d', '--density', action='store_true', help='Draw the scatterplot as a per-pixel density image')
+    parser.add_argument('-t', '--transfer', choices=['alpha', 'linear', 'sqrt', 'log'], default='alpha', help='Coverage to opacity transfer function for --density')
+    parser.add_argument('-s', '--sparse', type=int, default=2, help='With --density, points overlapping fewer markers than this are drawn as points')
+    return parser.parse_args()
+
+# Function to make one pass over the spilled values for both marginal histograms and, in density
+# mode, the per-pixel counts: one bin per output pixel of the 1.5 inch panel at the saved 600 dpi
+def count_values(values, low, high, density=False, width_px=900, height_px=900):
+    xlim, ylim = (0, high[0]), (0, high[1])
+    x_hist, y_hist = np.zeros(50, dtype=np.int64), np.zeros(50, dtype=np.int64)
+    counts = np.zeros(width_px * height_px, dtype=np.int64)
+    for chunk in value_chunks(values):
+        x_hist += np.histogram(chunk[:, 0], bins=50, range=(low[0], high[0]))[0]
+        y_hist += np.histogram(chunk[:, 1], bins=50, range=(low[1], high[1]))[0]
+        if density:
+            counts += np.bincount(pixel_index(chunk, xlim, ylim, width_px, height_px), minlength=counts.size)
+    return x_hist, y_hist, counts
+
+# Function to draw the scatterplot and both histograms and save the figure
+def plot_figure(values, low, high, x_hist, y_hist, counts, output_file, density=False, transfer='alpha', sparse=2):
+    # Set the style for the plot
+    plt.style.use('BME163')
+    xlim, ylim = (0, high[0]), (0, high[1])
+    width_px = height_px = int(1.5 * 600)
+
+    # Define the colors
+    iBlue = (88/255, 85/255, 120/255)
+    Grey = 'grey'
+    iGreen = (120/255, 172/255, 145/255)
+
+    # Create the figure and axes
+    figure = plt.figure(figsize=(3, 3))
+    main_panel = figure.add_axes([0.2, 0.2, 1.5/3, 1.5/3])  # Main scatter plot
+
+    # Histogram axes
+    left_panel = figure.add_axes([0.1, 0.2, 0.08, 1.5/3], sharey=main_panel)  # Left histogram
+    top_panel = figure.add_axes([0.2, 0.72, 1.5/3, 0.08], sharex=main_panel)  # Top histogram
+
+    x_bins = np.histogram_bin_edges(low[:1], bins=50, range=(low[0], high[0]))
+    y_bins = np.histogram_bin_edges(low[1:], bins=50, range=(low[1], high[1]))
+
+    # Histograms (transformed using log)
+    x_hist = log_transform(x_hist)
+    y_hist = log_transform(y_hist)
+    x_hist_norm = x_hist / max(x_hist) * (1.5/3)
+    y_hist_norm = y_hist / max(y_hist) * (1.5/3)
+
+    # plot the scatterplot
+    if density:
+        # s=10 markers are sqrt(10) points across; points whose marker overlaps fewer than --sparse
+        # markers (itself included) stay true points and are taken out of the image
+        counts = counts.copy()
+        marker_radius_px = np.sqrt(10) / 2 / 72 * 600
+        covered = marker_footprint(counts.reshape(height_px, width_px), marker_radius_px).ravel()
+        sparse_values = []
+        for chunk in value_chunks(values):
+            pixels = pixel_index(chunk, xlim, ylim, width_px, height_px)
+            is_sparse = covered[pixels] < sparse
+            counts -= np.bincount(pixels[is_sparse], minlength=counts.size)
+            sparse_values.append(chunk[is_sparse])
+        sparse_values = np.concatenate(sparse_values) if sparse_values else np.zeros((0, 2))
+        plot_density(main_panel, marker_footprint(counts.reshape(height_px, width_px), marker_radius_px),
+                     xlim, ylim, iBlue, transfer)
+        main_panel.scatter(sparse_values[:, 0], sparse_values[:, 1], s=10, color=iBlue, alpha=0.1, edgecolor='none')
+    else:
+        main_panel.scatter(values[:, 0], values[:, 1], s=10, color=iBlue, alpha=0.1, edgecolor='none')
+
+    # Plot histograms, one collection of bars each
+    plot_bars(top_panel, x_bins, x_hist_norm, iGreen, 'vertical')
+    plot_bars(left_panel, y_bins, y_hist_norm, Grey, 'horizontal')
+
+    # Set limits for the panels
+    main_panel.set_xlim(*xlim)
+    main_panel.set_ylim(*ylim)
+    top_panel.set_xlim(main_panel.get_xlim())
+    left_panel.set_ylim(main_panel.get_ylim())
+
+    # save the figure
+    plt.savefig(output_file, dpi=600)
+    plt.close(figure)
+
+def main():
+    args = parse_arguments()
+
+    # Read the data from the input file and transform, one chunk at a time
+    with tempfile.TemporaryFile() as spill:
+        values, low, high = spill_values(args.inputFile, spill)
+        x_hist, y_hist, counts = count_values(values, low, high, args.density)
+        plot_figure(values, low, high, x_hist, y_hist, counts, args.outputFile, args.density, args.transfer, args.sparse)
+
+if __name__ == '__main__':
+    main()
@@ -1,63 +1,85 @@
 
 
 import argparse
+import multiprocessing
+from typing import NamedTuple
 import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
 import numpy as np
+import bme163_io
+
+# cells with both a position and a cell type, as columns
+class CellData(NamedTuple):
+    barcodes: np.ndarray     # fixed-width bytes
+    x: np.ndarray            # float32
+    y: np.ndarray            # float32
+    cell_types: np.ndarray   # cell type names, indexed by celltype
+    celltype: np.ndarray     # int32 cell type code per cell
 
 def main():
     parser = argparse.ArgumentParser(description='Plot cell positions and densities.')
     parser.add_argument('-p', '--position', required=True, help='Path to the position.tsv file')
     parser.add_argument('-c', '--celltype', required=True, help='Path to the celltype.tsv file')
     parser.add_argument('-o', '--output', required=True, help='Output PNG file path')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Worker processes for the density calculation')
     args = parser.parse_args()
 
     position_data, celltype_data = read_data(args.position, args.celltype)
     data = merge_data(position_data, celltype_data)
 
-    plot_data(data, args.output)
+    plot_data(data, args.output, args.jobs)
+
+# whitespace-separated table split in bulk; returns an array of byte tokens, one row per line
+def read_table(file_path, columns, skip_header=False):
+    return bme163_io.read_table(file_path, width=columns, header=skip_header)[1]
+
+# row of the last occurrence of each key, in order of its first occurrence: a dict keeps a
+# repeated key where it was first inserted but with the last value
+def last_occurrences(keys):
+    _, first = np.unique(keys, return_index=True)
+    _, last = np.unique(keys[::-1], return_index=True)
+    return (len(keys) - 1 - last)[np.argsort(first)]
 
 def read_data(position_file, celltype_file):
-    position_data = {}
-    with open(position_file, 'r') as file:
-        for line in file:
-            parts = line.strip().split()
-            position_data[parts[0]] = (float(parts[1]), float(parts[2]))
-
-    celltype_data = {}
-    with open(celltype_file, 'r') as file:
-        next(file) 
-        for line in file:
-            parts = line.strip().split()
-            celltype_data[parts[2]] = parts[1]
+    positions = read_table(position_file, 3)
+    positions = positions[last_occurrences(positions[:, 0])]
+    position_data = (positions[:, 0], positions[:, 1].astype(np.float32), positions[:, 2].astype(np.float32))
+
+    celltypes = read_table(celltype_file, 3, skip_header=True)
+    celltypes = celltypes[last_occurrences(celltypes[:, 2])]
+    celltype_data = (celltypes[:, 2], celltypes[:, 1])
 
     return position_data, celltype_data
 
+# join positions to cell types on barcode through the sorted cell type barcodes
 def merge_data(position_data, celltype_data):
-    data = {}
-    for barcode, position in position_data.items():
-        if barcode in celltype_data:
-            cell_type = celltype_data[barcode]
-            data[barcode] = {'position': position, 'celltype': cell_type}
-    return data
+    barcodes, x, y = position_data
+    celltype_barcodes, celltype_names = celltype_data
+    order = np.argsort(celltype_barcodes)
+    sorted_barcodes = celltype_barcodes[order]
+    slot = np.minimum(np.searchsorted(sorted_barcodes, barcodes), max(len(order) - 1, 0))
+    found = np.flatnonzero(sorted_barcodes[slot] == barcodes) if len(order) else np.zeros(0, dtype=np.int64)
+    cell_types, celltype = np.unique(celltype_names[order[slot[found]]].astype(str), return_inverse=True)
+    return CellData(barcodes[found], x[found], y[found], cell_types, celltype.astype(np.int32))
 
 def plot_cells(panel, data, colors):
-    celltype_positions = {}
-    for barcode, info in data.items():
-        cell_type = info['celltype']
-        positions = celltype_positions.get(cell_type, [])
-        positions.append(info['position'])
-        celltype_positions[cell_type] = positions
-        
-
-        color = colors.get(cell_type, 'gray') 
-        panel.plot(info['position'][0], info['position'][1], 'o', 
-                   markeredgecolor='black', markerfacecolor=color, markersize=4, mew=0.5)
-    
-
-    for cell_type, positions in celltype_positions.items():
-        positions = np.array(positions)
-        median_x = np.median(positions[:, 0])
-        median_y = np.median(positions[:, 1])
+    positions = np.column_stack([data.x, data.y])
+    cell_types, codes = data.cell_types, data.celltype
+    # one scatter collection in file order, so overlapping cells stack as they always have
+    type_colors = np.array([mcolors.to_rgba(colors.get(str(cell_type), 'gray')) for cell_type in cell_types])
+    panel.scatter(positions[:, 0], positions[:, 1], s=4**2, marker='o',
+                  edgecolors='black', facecolors=type_colors[codes] if len(codes) else 'none', linewidths=0.5)
+
+    # label each type (in order of first appearance) at the median of its cells
+    first_seen = np.full(len(cell_types), len(codes))
+    np.minimum.at(first_seen, codes, np.arange(len(codes)))
+    order = np.argsort(codes, kind='stable')
+    groups = np.split(order, np.cumsum(np.bincount(codes, minlength=len(cell_types)))[:-1])
+
+    for code in np.argsort(first_seen):
+        cell_type, group = str(cell_types[code]), positions[groups[code]]
+        median_x = np.median(group[:, 0])
+        median_y = np.median(group[:, 1])
 
     #outline effect for labels
         panel.text(median_x, median_y, cell_type, fontsize=9, ha='center', va='center',
@@ -66,27 +88,93 @@ def plot_cells(panel, data, colors):
         panel.text(median_x + 0.05, median_y, cell_type, fontsize=8, ha='center', va='center',
                    color='black', weight='bold')
 
-def calculate_density(data, minimum_distance=8/72, panel_width=1.5, panel_height=1.5):
-    points = [info['position'] for info in data.values()]
-    xrange = max(p[0] for p in points) - min(p[0] for p in points)
-    yrange = max(p[1] for p in points) - min(p[1] for p in points)
-    density = []
-    for i, (x1, y1) in enumerate(points):
-        count = sum(1 for j, (x2, y2) in enumerate(points) if i != j and np.sqrt(
-            ((x1 - x2) / xrange * panel_width)**2 + ((y1 - y2) / yrange * panel_height)**2
-        ) < minimum_distance)
-        density.append(min(count, 100))
+# grid-hashed neighbour counts shared with density workers (inherited on fork, sent once per worker otherwise)
+density_state = {}
+
+def init_density_worker(state):
+    density_state.update(state)
+
+# neighbour counts for the given points: candidates come from each point's grid cell and the
+# 8 around it, and the distance test is the same expression the pairwise loop used
+def count_neighbors(points):
+    state = density_state
+    x, y, keys, order, sorted_keys = state['x'], state['y'], state['keys'], state['order'], state['sorted_keys']
+    counts = np.zeros(len(points), dtype=np.int64)
+    slot = np.arange(len(points))
+    for step in state['steps']:
+        lo = np.searchsorted(sorted_keys, keys[points] + step, side='left')
+        hi = np.searchsorted(sorted_keys, keys[points] + step, side='right')
+        sizes = hi - lo
+        k = np.repeat(slot, sizes)
+        i = points[k]
+        j = order[np.repeat(lo - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())]
+        near = (i != j) & (np.sqrt(
+            ((x[i] - x[j]) / state['xrange'] * state['panel_width'])**2 + ((y[i] - y[j]) / state['yrange'] * state['panel_height'])**2
+        ) < state['minimum_distance'])
+        counts += np.bincount(k[near], minlength=len(points))
+    return counts
+
+def calculate_density(data, minimum_distance=8/72, panel_width=1.5, panel_height=1.5, chunk_pairs=1 << 22, jobs=1):
+    x, y = data.x.astype(float), data.y.astype(float)
+    if not len(x):
+        return np.zeros(0, dtype=np.int64)
+    # an axis with every value equal spans a single grid cell, and its distance term is 0
+    xrange = x.max() - x.min() or 1.0
+    yrange = y.max() - y.min() or 1.0
+
+    # grid cells a little over one minimum_distance wide in panel inches, so every
+    # neighbour of a point sits in its own cell or one of the 8 around it
+    cell_size = minimum_distance * (1 + 1e-9)
+    cell_x = np.floor((x - x.min()) / xrange * panel_width / cell_size).astype(np.int64) + 1
+    cell_y = np.floor((y - y.min()) / yrange * panel_height / cell_size).astype(np.int64) + 1
+    rows = cell_y.max() + 2
+    keys = cell_x * rows + cell_y
+    order = np.argsort(keys, kind='stable')
+    state = dict(x=x, y=y, keys=keys, order=order, sorted_keys=keys[order],
+                 steps=[dx * rows + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)],
+                 xrange=xrange, yrange=yrange, panel_width=panel_width, panel_height=panel_height,
+                 minimum_distance=minimum_distance)
+
+    # on a grid a quarter of minimum_distance wide, the 21 cells around a point's own cell lie
+    # entirely within minimum_distance of it, so their population (less the point) is a lower
+    # bound on its count; points already at the cap need no pair counting
+    fine_size = minimum_distance / 4 * (1 - 1e-6)
+    fine_x = np.floor((x - x.min()) / xrange * panel_width / fine_size).astype(np.int64) + 2
+    fine_y = np.floor((y - y.min()) / yrange * panel_height / fine_size).astype(np.int64) + 2
+    fine_counts = np.zeros((fine_x.max() + 3, fine_y.max() + 3), dtype=np.int64)
+    np.add.at(fine_counts, (fine_x, fine_y), 1)
+    inner = sum(fine_counts[fine_x + dx, fine_y + dy] for dx in range(-2, 3) for dy in range(-2, 3)
+                if (abs(dx) + 1)**2 + (abs(dy) + 1)**2 < 16)
+    pending = np.flatnonzero(inner - 1 < 100)
+
+    # split the rest so no chunk expands to more than chunk_pairs candidate pairs
+    cell_sizes = np.bincount(keys, minlength=keys.max() + rows + 2)
+    candidates = sum(cell_sizes[keys[pending] + step] for step in state['steps'])
+    boundaries = np.searchsorted(np.cumsum(candidates), np.arange(chunk_pairs, candidates.sum(), chunk_pairs))
+    chunks = [chunk for chunk in np.split(pending, np.unique(boundaries)) if chunk.size]
+
+    if jobs > 1 and len(chunks) > 1:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        with context.Pool(jobs, initializer=init_density_worker, initargs=(state,)) as pool:
+            counts = pool.map(count_neighbors, chunks)
+    else:
+        init_density_worker(state)
+        counts = [count_neighbors(chunk) for chunk in chunks]
+    density = np.full(len(x), 100, dtype=np.int64)
+    if counts:
+        density[pending] = np.minimum(np.concatenate(counts), 100)
     return density
 
 def plot_density(panel, data, density):
     viridis_cmap = plt.get_cmap('viridis')
     norm = plt.Normalize(vmin=0, vmax=100)
-    points = [info['position'] for info in data.values()]
     colors = viridis_cmap(norm(density))
-    panel.scatter([p[0] for p in points], [p[1] for p in points], 
+    panel.scatter(data.x, data.y, 
                   color=colors, edgecolor='none', s=4**2)
 
-def plot_data(data, output_file):
+# density is calculated here unless it is passed in
+def plot_data(data, output_file, jobs=1, density=None):
     figure_width, figure_height = 5, 3
     plt.figure(figsize=(figure_width, figure_height))
     plt.style.use('BME163')
@@ -107,14 +195,15 @@ def plot_data(data, output_file):
     colors = {'monocyte': 'red', 'neuron': 'blue', 'glia': 'green', 'tCell': 'purple', 'bCell': 'cyan'}
 
     plot_cells(panel1, data, colors)
-    density = calculate_density(data)
+    if density is None:
+        density = calculate_density(data, jobs=jobs)
     scatter = plot_density(panel2, data, density)
 
    
-    sm = plt.cm.ScalarMappable(cmap=plt.cm.viridis, norm=plt.Normalize(vmin=min(density), vmax=max(density)))
+    sm = plt.cm.ScalarMappable(cmap=plt.cm.viridis, norm=plt.Normalize(vmin=density.min(), vmax=density.max()))
     sm.set_array([])  
     cbar = plt.colorbar(sm, cax=panel3)
-    cbar.set_ticks([min(density), max(density)])
+    cbar.set_ticks([density.min(), density.max()])
     cbar.set_ticklabels(['Min', 'Max'])
 
     panel2.text(0.05, 0.05, 'Density', transform=panel2.transAxes, fontsize=8, ha='left', va='bottom')
@@ -0,0 +1,334 @@
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+# Benchmarks the parse, compute and render stages of each figure pipeline on synthetic inputs
+# of increasing size. Every (pipeline, size) runs in a fresh process so peak memory is its own,
+# and the results are written as JSON for comparing commits.
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = {
+    'week2': 'Prasanna_Hema_BME163_Assignment_Week2.py',
+    'week3': 'Prasanna_Hema_BME163_Assignment_Week3.py',
+    'week5': 'Assignment_Week5.py',
+    'week6': 'Assignment_Week6.py',
+    'final': 'Prasanna_Hema_BME163_Assignment_Final.py',
+}
+STAGES = ('parse', 'compute', 'render')
+# rows generated per write, so generating 10^7 records never holds them all as strings
+GENERATE_ROWS = 1 << 20
+# Final: every read and transcript lands in this window, so all of them are drawn
+LOCUS = ('chr1', 1_000_000, 1_100_000)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Time and profile the figure pipelines on synthetic data.')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='JSON results file')
+    parser.add_argument('-p', '--pipelines', nargs='+', choices=list(SCRIPTS), default=list(SCRIPTS), help='Pipelines to run')
+    parser.add_argument('-n', '--sizes', nargs='+', type=int, default=[10**3, 10**4, 10**5, 10**6, 10**7],
+                        help='Record counts: points, cells, sequences, genes or reads per input')
+    parser.add_argument('-w', '--workdir', default='benchmark_data', help='Directory for generated inputs and figures (inputs are reused)')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='Runs per pipeline and size')
+    parser.add_argument('-t', '--timeout', type=float, default=3600, help='Seconds before a run is abandoned')
+    parser.add_argument('--seed', type=int, default=163, help='Random seed for the generators')
+    parser.add_argument('--final_dpi', type=int, default=600, help='Output resolution of the Final figure')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='Also record each stage\'s peak traced allocation (peak_bytes) in a second, slower run per size')
+    parser.add_argument('--worker', nargs=2, metavar=('PIPELINE', 'SIZE'), help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+# the script as a module, without running its command line
+def load_script(pipeline):
+    if REPO not in sys.path:
+        sys.path.insert(0, REPO)
+    spec = importlib.util.spec_from_file_location(pipeline, os.path.join(REPO, SCRIPTS[pipeline]))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# write lines produced `rows` at a time by make_lines(rng, first_row, row_count)
+def write_lines(path, header, rows, make_lines, rng):
+    with open(path, 'w') as file:
+        if header:
+            file.write(header + '\n')
+        for first in range(0, rows, GENERATE_ROWS):
+            lines = make_lines(rng, first, min(GENERATE_ROWS, rows - first))
+            if lines:
+                file.write('\n'.join(lines) + '\n')
+
+# Week2: two expression columns, lognormal with a shared gene effect
+def generate_week2(workdir, n, rng):
+    path = os.path.join(workdir, f'week2_{n}.tsv')
+    def make_lines(rng, first, count):
+        gene = rng.lognormal(3, 2, count)
+        x, y = gene * rng.lognormal(0, 0.5, count), gene * rng.lognormal(0, 0.5, count)
+        return [f'g{first + i}\t{a:.3f}\t{b:.3f}' for i, (a, b) in enumerate(zip(x.tolist(), y.tolist()))]
+    write_lines(path, 'gene\ts1\ts2', n, make_lines, rng)
+    return {'input': path}
+
+# Week3: tSNE positions in five clusters, one per cell type, and the cell type table
+def generate_week3(workdir, n, rng):
+    positions, celltypes = os.path.join(workdir, f'week3_{n}_positions.tsv'), os.path.join(workdir, f'week3_{n}_celltypes.tsv')
+    cell_types = ['monocyte', 'neuron', 'glia', 'tCell', 'bCell']
+    centers = rng.uniform(-40, 40, (len(cell_types), 2))
+    codes = rng.integers(0, len(cell_types), n)
+    def position_lines(rng, first, count):
+        xy = centers[codes[first:first + count]] + rng.normal(0, 6, (count, 2))
+        return [f'BC{first + i}\t{x:.4f}\t{y:.4f}' for i, (x, y) in enumerate(xy.tolist())]
+    def celltype_lines(rng, first, count):
+        return [f'{first + i}\t{cell_types[code]}\tBC{first + i}' for i, code in enumerate(codes[first:first + count].tolist())]
+    write_lines(positions, None, n, position_lines, rng)
+    write_lines(celltypes, 'x\ttype\tbarcode', n, celltype_lines, rng)
+    return {'positions': positions, 'celltypes': celltypes}
+
+# Week5: 20 base splice sites alternating 5' and 3', with a consensus pair at the junction,
+# and one solid glyph image per base
+def generate_week5(workdir, n, rng):
+    path = os.path.join(workdir, f'week5_{n}.fa')
+    def make_lines(rng, first, count):
+        codes = rng.integers(0, 4, (count, 20), dtype=np.uint8)
+        seqs = np.frombuffer(b'ATGC', dtype=np.uint8)[codes]
+        seqs[0::2, 10:12] = np.frombuffer(b'GT', dtype=np.uint8)
+        seqs[1::2, 8:10] = np.frombuffer(b'AG', dtype=np.uint8)
+        return [f">site{first + i} {'5' if (first + i) % 2 == 0 else '3'}'SS\n{seq.tobytes().decode()}"
+                for i, seq in enumerate(seqs)]
+    write_lines(path, None, n, make_lines, rng)
+    glyphs = {}
+    for base, color in zip('ATGC', ['green', 'red', 'orange', 'blue']):
+        glyphs[base] = os.path.join(workdir, f'week5_{base}.png')
+        if not os.path.exists(glyphs[base]):
+            plt.imsave(glyphs[base], np.broadcast_to(matplotlib.colors.to_rgba(color), (64, 64, 4)).copy())
+    return {'input': path, 'glyphs': [glyphs[base] for base in 'ATGC']}
+
+# Week6: 16 time points of a noisy cosine peaking at each gene's phase, and the phase table
+def generate_week6(workdir, n, rng):
+    expression, phase = os.path.join(workdir, f'week6_{n}_exp.tsv'), os.path.join(workdir, f'week6_{n}_phase.tsv')
+    named = ['Clock', 'Insig2', 'Nr1d1', 'Dbp', 'Per3', 'Per1', 'Per2', 'Cry1', 'Arntl']
+    phases = rng.uniform(0, 24, n)
+    times = np.arange(0, 48, 3)
+    def expression_lines(rng, first, count):
+        peak = phases[first:first + count, None]
+        fpkm = np.exp(rng.normal(1, 1, (count, 1))) * (1.2 + np.cos((times - peak) / 24 * 2 * np.pi))
+        fpkm += rng.uniform(0, 0.1, fpkm.shape)
+        return [f'ENSMUSG{first + i:011d}\t{named[first + i] if first + i < len(named) else f"gene{first + i}"}\t'
+                + '\t'.join(f'{value:.4f}' for value in row) for i, row in enumerate(fpkm.tolist())]
+    def phase_lines(rng, first, count):
+        return [f'ENSMUSG{first + i:011d}\t{value:.1f}' for i, value in enumerate(phases[first:first + count].tolist())]
+    write_lines(expression, 'Ensembl_ID\tGene name\t' + '\t'.join(f'FPKM_CT{time}' for time in times), n, expression_lines, rng)
+    write_lines(phase, 'Ensembl_ID\tPeak_phase(CT)', n, phase_lines, rng)
+    return {'expression': expression, 'phase': phase}
+
+# PSL lines for `count` reads of one to four blocks inside the locus
+def psl_lines(rng, first, count):
+    chromosome, start, end = LOCUS
+    blocks = rng.integers(1, 5, count)
+    sizes = rng.integers(50, 300, (count, 4))
+    gaps = rng.integers(0, 500, (count, 4))
+    gaps[:, 0] = 0
+    offsets = np.cumsum(gaps + np.roll(sizes, 1, axis=1) * (np.arange(4) > 0), axis=1)
+    read_starts = rng.integers(start, end - offsets[:, -1] - sizes[:, -1], count)
+    lines = []
+    for read_start, block_count, size, offset in zip(read_starts.tolist(), blocks.tolist(), sizes.tolist(), offsets.tolist()):
+        size, offset = size[:block_count], offset[:block_count]
+        read_end = read_start + offset[-1] + size[-1]
+        lines.append(f'0\t0\t0\t0\t0\t0\t0\t0\t+\tread\t0\t0\t0\t{chromosome}\t{end * 2}\t{read_start}\t{read_end}\t{block_count}\t'
+                     + ','.join(map(str, size)) + ',\t' + ','.join(map(str, offset)) + ',\t'
+                     + ','.join(str(read_start + position) for position in offset) + ',')
+    return lines
+
+# GTF lines for `count` transcripts of three exons, the middle one also CDS, inside the locus
+def gtf_lines(rng, first, count):
+    chromosome, start, end = LOCUS
+    transcript_starts = rng.integers(start, end - 3000, count)
+    lines = []
+    for i, transcript_start in enumerate(transcript_starts.tolist()):
+        attributes = f'gene_id "G{first + i}"; transcript_id "T{first + i}";'
+        for exon in range(3):
+            exon_start = transcript_start + exon * 1000
+            lines.append(f'{chromosome}\tbench\texon\t{exon_start}\t{exon_start + 300}\t.\t+\t.\t{attributes}')
+            if exon == 1:
+                lines.append(f'{chromosome}\tbench\tCDS\t{exon_start + 50}\t{exon_start + 250}\t.\t+\t0\t{attributes}')
+    return lines
+
+# Final: n reads in each PSL, and one transcript per hundred reads
+def generate_final(workdir, n, rng):
+    files = {name: os.path.join(workdir, f'final_{n}.{name}') for name in ('psl5', 'psl6', 'gtf')}
+    write_lines(files['psl5'], None, n, psl_lines, rng)
+    write_lines(files['psl6'], None, n, psl_lines, rng)
+    write_lines(files['gtf'], None, max(1, n // 100), gtf_lines, rng)
+    return files
+
+GENERATORS = {'week2': generate_week2, 'week3': generate_week3, 'week5': generate_week5,
+              'week6': generate_week6, 'final': generate_final}
+
+# generated inputs for a pipeline and size, made once per workdir and seed
+def prepare_inputs(pipeline, n, workdir, seed):
+    manifest = os.path.join(workdir, f'{pipeline}_{n}_{seed}.json')
+    if os.path.exists(manifest):
+        with open(manifest) as file:
+            return json.load(file), 0.0
+    began = time.perf_counter()
+    inputs = GENERATORS[pipeline](workdir, n, np.random.default_rng([seed, n]))
+    seconds = time.perf_counter() - began
+    with open(manifest, 'w') as file:
+        json.dump(inputs, file)
+    return inputs, seconds
+
+# the stages of a pipeline as functions of the state the previous ones leave behind
+def week2_stages(module, inputs, output, args):
+    import tempfile
+    spill = tempfile.TemporaryFile()
+    def parse(state):
+        state['values'], state['low'], state['high'] = module.spill_values(inputs['input'], spill)
+    def compute(state):
+        state['hist'] = module.count_values(state['values'], state['low'], state['high'], density=True)
+    def render(state):
+        module.plot_figure(state['values'], state['low'], state['high'], *state['hist'], output, density=True)
+    return parse, compute, render
+
+def week3_stages(module, inputs, output, args):
+    def parse(state):
+        state['tables'] = module.read_data(inputs['positions'], inputs['celltypes'])
+    def compute(state):
+        state['data'] = module.merge_data(*state['tables'])
+        state['density'] = module.calculate_density(state['data'])
+    def render(state):
+        module.plot_data(state['data'], output, density=state['density'])
+    return parse, compute, render
+
+def week5_stages(module, inputs, output, args):
+    def parse(state):
+        state['records'] = list(module.read_sequences(inputs['input']))
+        state['glyphs'] = [module.load_glyph(path) for path in inputs['glyphs']]
+    def compute(state):
+        state['freqs'] = module.calculate_frequencies(state['records'])
+    def render(state):
+        module.plot_sequence_logos(state['freqs'], state['glyphs'], output, module.logo_template())
+    return parse, compute, render
+
+def week6_stages(module, inputs, output, args):
+    def parse(state):
+        state['tables'] = (module.load_data(inputs['expression'], module.expression_columns)
+                           + module.load_data(inputs['phase'], module.phase_columns))
+    def compute(state):
+        state['genes'], matrix, state['gene_rows'], state['columns'] = module.build_matrix(*state['tables'])
+        state['display'] = module.resample_rows(matrix, int(2.5 * 600))
+    def render(state):
+        module.plot_heatmap(state['display'], len(state['genes']), state['gene_rows'], state['columns'],
+                            'Clock,Insig2,Nr1d1,Dbp,Per3,Per1,Per2,Cry1,Arntl', output)
+    return parse, compute, render
+
+# render stacks the reads again while drawing; compute times the stacking on its own
+def final_stages(module, inputs, output, args):
+    chromosome, start, end = LOCUS
+    def parse(state):
+        files = SimpleNamespace(gtf=inputs['gtf'], psl5=inputs['psl5'], psl6=inputs['psl6'], index=False)
+        state['inputs'] = module.load_inputs(files, {chromosome: (start, end)})[chromosome]
+    def compute(state):
+        loaded = state['inputs']
+        for reads, sort_by in ((loaded.psl5, 'end'), (loaded.psl6, 'start')):
+            module.stacked_order(reads.starts, reads.ends, sort_by)
+        state['region'] = module.RegionData(module.group_transcripts(loaded.gtf_parts), loaded.psl5, loaded.psl6,
+                                            module.calculate_coverage(loaded.psl6, start, end))
+    def render(state):
+        module.render_region(state['region'], start, end, output, args.final_dpi)
+    return parse, compute, render
+
+STAGE_BUILDERS = {'week2': week2_stages, 'week3': week3_stages, 'week5': week5_stages,
+                  'week6': week6_stages, 'final': final_stages}
+
+# peak resident set size of this process so far, in bytes
+def max_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+# run one pipeline at one size in this process and return its stage measurements; with `trace`
+# each stage's peak traced allocation is measured, which slows parsing many times over
+def run_worker(args, pipeline, n, trace=False):
+    with open(os.path.join(args.workdir, f'{pipeline}_{n}_{args.seed}.json')) as file:
+        inputs = json.load(file)
+    output = os.path.join(args.workdir, f'{pipeline}_{n}.png')
+    module = load_script(pipeline)
+    stages = STAGE_BUILDERS[pipeline](module, inputs, output, args)
+    state, results = {}, {}
+    if trace:
+        tracemalloc.start()
+    for name, stage in zip(STAGES, stages):
+        if trace:
+            tracemalloc.reset_peak()
+        began = time.perf_counter()
+        stage(state)
+        seconds = time.perf_counter() - began
+        results[name] = {'seconds': seconds, 'max_rss_bytes': max_rss_bytes()}
+        if trace:
+            results[name]['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        plt.close('all')
+    return results
+
+# stage measurements from a fresh worker process
+def run_in_process(args, pipeline, n, trace=False):
+    command = [sys.executable, os.path.abspath(__file__), '--worker', pipeline, str(n), '--workdir', args.workdir,
+               '--seed', str(args.seed), '--final_dpi', str(args.final_dpi)] + (['--tracemalloc'] if trace else [])
+    run = subprocess.run(command, capture_output=True, text=True, timeout=args.timeout)
+    if run.returncode:
+        raise RuntimeError((run.stderr.strip().splitlines() or [f'exit code {run.returncode}'])[-1])
+    return json.loads(run.stdout.strip().splitlines()[-1])
+
+# run every pipeline and size, each in a fresh process, printing a line per run
+def run_benchmarks(args):
+    os.makedirs(args.workdir, exist_ok=True)
+    commit = subprocess.run(['git', '-C', REPO, 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    report = {'started': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': commit or None,
+              'python': platform.python_version(), 'numpy': np.__version__, 'matplotlib': matplotlib.__version__,
+              'platform': platform.platform(), 'cpus': os.cpu_count(), 'sizes': args.sizes, 'results': []}
+    for pipeline in args.pipelines:
+        for n in args.sizes:
+            inputs, generate_seconds = prepare_inputs(pipeline, n, args.workdir, args.seed)
+            input_bytes = sum(os.path.getsize(path) for paths in inputs.values()
+                              for path in (paths if isinstance(paths, list) else [paths]))
+            for repeat in range(args.repeat):
+                result = {'pipeline': pipeline, 'records': n, 'repeat': repeat, 'input_bytes': input_bytes,
+                          'generate_seconds': generate_seconds, 'stages': None, 'error': None}
+                try:
+                    stages = run_in_process(args, pipeline, n)
+                    if args.tracemalloc:
+                        for name, traced in run_in_process(args, pipeline, n, trace=True).items():
+                            stages[name]['peak_bytes'] = traced['peak_bytes']
+                    result['stages'] = stages
+                except subprocess.TimeoutExpired:
+                    result['error'] = f'timed out after {args.timeout:g}s'
+                except RuntimeError as error:
+                    result['error'] = str(error)
+                report['results'].append(result)
+                if result['stages']:
+                    timings = '\t'.join(f"{name} {stage['seconds']:.3f}s" for name, stage in result['stages'].items())
+                    peak = max(stage['max_rss_bytes'] for stage in result['stages'].values()) / 1e6
+                    print(f'{pipeline}\t{n}\t{timings}\tmax rss {peak:.0f} MB')
+                else:
+                    print(f"{pipeline}\t{n}\tfailed: {result['error']}")
+                # written after every run, so a long sweep keeps what finished
+                with open(args.output, 'w') as file:
+                    json.dump(report, file, indent=1)
+
+def main():
+    args = parse_arguments()
+    if args.worker:
+        pipeline, n = args.worker
+        print(json.dumps(run_worker(args, pipeline, int(n), args.tracemalloc)))
+        return
+    run_benchmarks(args)
+
+if __name__ == '__main__':
+    main()
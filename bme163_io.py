@@ -0,0 +1,265 @@
+import gzip
+import mmap
+import os
+from typing import NamedTuple
+import numpy as np
+
+# Shared input readers for the BME163 scripts. Files are read in large byte chunks that are
+# split in bulk and converted by numpy, never a Python split per line. gzip and bgzip inputs
+# are decompressed transparently; plain files can be memory-mapped instead of read.
+
+CHUNK_BYTES = 1 << 22
+GZIP_MAGIC = b'\x1f\x8b'
+
+# PSL alignments as columns, blocks in CSR form: record i owns blocks
+# block_offsets[i]:block_offsets[i + 1] of the flat block arrays
+class PslRecords(NamedTuple):
+    names: np.ndarray          # tName per record, bytes
+    starts: np.ndarray         # int64 tStart
+    ends: np.ndarray           # int64 tEnd
+    block_offsets: np.ndarray  # int64, one longer than the record count
+    block_starts: np.ndarray   # int64 tStarts
+    block_sizes: np.ndarray    # int64 blockSizes
+
+# GTF features as columns, in file order
+class GtfRecords(NamedTuple):
+    chromosomes: np.ndarray    # seqname per record, bytes
+    features: np.ndarray       # feature type per record, bytes
+    starts: np.ndarray         # int64
+    ends: np.ndarray           # int64
+    transcripts: np.ndarray    # transcript_id attribute per record, bytes
+
+# gzip and bgzip (a series of gzip members) share the gzip magic number
+def is_gzip(path):
+    with open(path, 'rb') as file:
+        return file.read(2) == GZIP_MAGIC
+
+def open_input(path):
+    if is_gzip(path):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb', buffering=CHUNK_BYTES)
+
+# the whole file as bytes, or as a read-only memory map for a plain, non-empty file
+def read_bytes(path, use_mmap=False):
+    if use_mmap and not is_gzip(path) and os.path.getsize(path):
+        with open(path, 'rb') as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    with open_input(path) as file:
+        return file.read()
+
+# a readable source for the file: its read-only memory map when use_mmap is set and the file is
+# plain and non-empty, otherwise an opened (and, for gzip, decompressing) file
+def open_source(path, use_mmap=False):
+    source = read_bytes(path, True) if use_mmap else None
+    return source if isinstance(source, mmap.mmap) else open_input(path)
+
+# byte blocks of roughly chunk_bytes that always end on a line boundary, with carriage returns
+# removed, after skipping the first skip_lines lines; only one block at a time is ever copied
+# out of a memory map
+def iter_blocks(path, chunk_bytes=CHUNK_BYTES, skip_lines=0, use_mmap=False):
+    with open_source(path, use_mmap) as file:
+        for _ in range(skip_lines):
+            file.readline()
+        remainder = b''
+        while True:
+            block = file.read(chunk_bytes)
+            if not block:
+                break
+            block = remainder + block.replace(b'\r', b'')
+            cut = block.rfind(b'\n') + 1
+            block, remainder = block[:cut], block[cut:]
+            if block:
+                yield block
+        if remainder.strip():
+            yield remainder + b'\n'
+
+def header_fields(path, delimiter=None):
+    with open_input(path) as file:
+        return [field.decode() for field in file.readline().strip().split(delimiter)]
+
+# (rows, columns) array of byte fields for a block of lines, only the given column positions
+# (all width of them when columns is None) ever becoming array entries; delimiter None splits on
+# any whitespace. Blank lines are skipped and fields past the first width are ignored, as a
+# per-line split() indexed by position would; a line with fewer than width fields is an error
+def split_fields(block, width, delimiter=None, columns=None):
+    block = block.rstrip(b'\n') + b'\n' if block.strip() else b''
+    # every line closed by a b'\0' token, so rows can be checked without splitting line by line
+    if delimiter is None:
+        tokens = block.replace(b'\n', b' \0 ').split()
+    else:
+        tokens = block.replace(b'\n', delimiter + b'\0' + delimiter).split(delimiter)[:-1]
+    lines = block.count(b'\n')
+    stride = width + 1
+    if len(tokens) != lines * stride or tokens[width::stride].count(b'\0') != lines:
+        tokens, stride = [], width
+        for line in block.split(b'\n')[:-1]:
+            if not line.strip():
+                continue
+            fields = line.split(delimiter)
+            if len(fields) < width:
+                raise ValueError(f'{len(fields)} fields where {width} are expected: {line[:80]!r}')
+            tokens.extend(fields[:width])
+    columns = range(width) if columns is None else columns
+    fields = np.empty((len(tokens) // stride, len(columns)), dtype=object)
+    for position, column in enumerate(columns):
+        fields[:, position] = tokens[column::stride]
+    return fields.astype(bytes) if fields.size else np.zeros(fields.shape, dtype=bytes)
+
+# split_fields for a block of the file at path, naming the file when a line is short
+def table_fields(path, block, width, delimiter, columns):
+    try:
+        return split_fields(block, width, delimiter, columns)
+    except ValueError as error:
+        raise ValueError(f'{path}: {error}') from None
+
+# column positions for a mix of indices and header names
+def column_indices(columns, headers):
+    return [headers.index(column) if isinstance(column, str) else column for column in columns]
+
+# a table as chunks of byte fields (only the requested columns, all of them when columns is
+# None); width comes from the header line, or is given for headerless tables
+def iter_table(path, columns=None, delimiter=None, header=False, width=None, chunk_bytes=CHUNK_BYTES, use_mmap=False):
+    headers = header_fields(path, delimiter) if header else None
+    width = width or len(headers)
+    selected = column_indices(columns, headers) if columns is not None else None
+    for block in iter_blocks(path, chunk_bytes, skip_lines=1 if header else 0, use_mmap=use_mmap):
+        yield table_fields(path, block, width, delimiter, selected)
+
+# the header names (None without a header) and the whole table as one (rows, columns) array of
+# byte fields, split chunk by chunk (from the memory map of a plain file with use_mmap), so the
+# file's bytes are never all held at once
+def read_table(path, columns=None, delimiter=None, header=False, width=None, use_mmap=False, chunk_bytes=CHUNK_BYTES):
+    headers = header_fields(path, delimiter) if header else None
+    chunks = list(iter_table(path, columns, delimiter, header, width, chunk_bytes, use_mmap))
+    if not chunks:
+        chunks = [np.zeros((0, len(columns) if columns is not None else width or len(headers)), dtype=bytes)]
+    return headers, np.concatenate(chunks)
+
+# yields (header, sequence) bytes for each FASTA record, without the '>'; wrapped sequence
+# lines are joined once per record
+def iter_fasta(path, use_mmap=False):
+    source = open_source(path, use_mmap)
+    try:
+        header, lines = None, []
+        for line in iter(source.readline, b''):
+            line = line.strip()
+            if line.startswith(b'>'):
+                if lines:
+                    yield header, b''.join(lines)
+                header, lines = line[1:], []
+            elif line:
+                lines.append(line)
+        if lines:
+            yield header, b''.join(lines)
+    finally:
+        source.close()
+
+# the given columns, as lists of bytes, of the lines of a block holding at least `width`
+# tab-separated fields; a block of exactly `width` fields on every line is split in one go
+def tab_columns(block, width, skip_prefix, columns):
+    lines = block.split(b'\n')[:-1]
+    if set(map(bytes.count, lines, [b'\t'] * len(lines))) - {width - 1} or \
+            block.startswith(skip_prefix) or any(b'\n' + prefix in block for prefix in skip_prefix):
+        block = b'\n'.join(
+            line if line.count(b'\t') == width - 1 else b'\t'.join(line.split(b'\t', width)[:width])
+            for line in lines if line.count(b'\t') >= width - 1 and not line.startswith(skip_prefix))
+    body = block.rstrip(b'\n')
+    tokens = body.replace(b'\n', b'\t').split(b'\t') if body else []
+    return [tokens[column::width] for column in columns]
+
+# comma-separated integer lists (one per row, trailing comma optional) as flat values and per-row counts
+def int_lists(column):
+    column = np.char.rstrip(column, b',')
+    counts = np.char.count(column, b',') + (column != b'')
+    values = b','.join(column).split(b',') if counts.sum() else []
+    return np.array(values, dtype=np.int64), counts
+
+# PSL alignments, optionally only those on the given chromosomes, or only those overlapping one
+# of the windows ({chromosome: (start, end)}), whose block lists are then the only ones decoded;
+# rows with missing or non-numeric coordinates are skipped, and each alignment keeps as many
+# blocks as both of its block lists provide
+def read_psl(path, chromosomes=None, windows=None, chunk_bytes=CHUNK_BYTES):
+    names, starts, ends, counts, block_starts, block_sizes = [], [], [], [], [], []
+    if windows is not None:
+        chromosomes = windows
+    wanted = np.array(sorted(chromosomes), dtype=bytes) if chromosomes is not None else None
+    for block in iter_blocks(path, chunk_bytes):
+        # tName, tStart, tEnd, blockSizes, tStarts; the block lists only become arrays for the
+        # rows that are kept
+        chromosome_names, start_fields, end_fields, size_lists, start_lists = tab_columns(
+            block, 21, (b'start', b'psLayout', b'match', b'-', b'#'), [13, 15, 16, 18, 20])
+        chromosome_names, start_fields, end_fields = (np.array(column, dtype=bytes) for column in
+                                                      (chromosome_names, start_fields, end_fields))
+        keep = np.char.isdigit(start_fields) & np.char.isdigit(end_fields)
+        if wanted is not None:
+            keep &= np.isin(chromosome_names, wanted)
+        if windows is not None:
+            read_starts = np.where(keep, start_fields, b'0').astype(np.int64)
+            read_ends = np.where(keep, end_fields, b'0').astype(np.int64)
+            inside = np.zeros(len(keep), dtype=bool)
+            for chromosome, (start, end) in windows.items():
+                inside |= (chromosome_names == str(chromosome).encode()) & (read_starts < end) & (read_ends > start)
+            keep &= inside
+        rows = np.flatnonzero(keep)
+        fields = np.empty((len(rows), 5), dtype=object)
+        fields[:, 0], fields[:, 1], fields[:, 2] = chromosome_names[rows], start_fields[rows], end_fields[rows]
+        fields[:, 3] = [size_lists[row] for row in rows]
+        fields[:, 4] = [start_lists[row] for row in rows]
+        fields = fields.astype(bytes) if len(rows) else np.zeros((0, 5), dtype=bytes)
+        try:
+            sizes, size_counts = int_lists(fields[:, 3])
+            block_start_values, start_counts = int_lists(fields[:, 4])
+        except ValueError:
+            # some block list is malformed: drop every such row and convert again
+            valid = np.ones(len(fields), dtype=bool)
+            for column in (3, 4):
+                valid &= np.char.isdigit(np.char.replace(np.char.rstrip(fields[:, column], b','), b',', b''))
+            fields = fields[valid]
+            sizes, size_counts = int_lists(fields[:, 3])
+            block_start_values, start_counts = int_lists(fields[:, 4])
+        count = np.minimum(size_counts, start_counts)
+        # first `count` entries of each row's lists
+        size_first = np.cumsum(size_counts) - size_counts
+        start_first = np.cumsum(start_counts) - start_counts
+        within = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        names.append(fields[:, 0].astype(chromosome_names.dtype))
+        starts.append(fields[:, 1].astype(np.int64))
+        ends.append(fields[:, 2].astype(np.int64))
+        counts.append(count)
+        block_sizes.append(sizes[np.repeat(size_first, count) + within])
+        block_starts.append(block_start_values[np.repeat(start_first, count) + within])
+    counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+    block_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=block_offsets[1:])
+    join = lambda parts, dtype: np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+    return PslRecords(join(names, bytes), join(starts, np.int64), join(ends, np.int64), block_offsets,
+                      join(block_starts, np.int64), join(block_sizes, np.int64))
+
+# a bytes array cast down to the width of its longest entry
+def narrow(values):
+    return values.astype(f'S{max(np.char.str_len(values).max(), 1)}') if len(values) else values
+
+# GTF records of the given feature types, optionally only on the given chromosomes
+def read_gtf(path, features=(b'exon', b'CDS'), chromosomes=None, chunk_bytes=CHUNK_BYTES):
+    columns = [[] for _ in GtfRecords._fields]
+    wanted = np.array(sorted(chromosomes), dtype=bytes) if chromosomes is not None else None
+    for block in iter_blocks(path, chunk_bytes):
+        # seqname, feature, start, end, attributes, each its own array so short fields stay narrow;
+        # the long attribute field only becomes an array for the rows that are kept
+        chromosome_names, feature_types, start_fields, end_fields, attributes = tab_columns(block, 9, (b'#',), [0, 2, 3, 4, 8])
+        chromosome_names, feature_types = np.array(chromosome_names, dtype=bytes), np.array(feature_types, dtype=bytes)
+        keep = np.isin(feature_types, np.array(features, dtype=bytes))
+        if wanted is not None:
+            keep &= np.isin(chromosome_names, wanted)
+        rows = np.flatnonzero(keep)
+        if not len(rows):
+            continue
+        attributes = np.array([attributes[row] for row in rows], dtype=bytes)
+        transcripts = np.char.partition(np.char.partition(attributes, b'transcript_id "')[:, 2], b'"')[:, 0]
+        for column, values in zip(columns, (narrow(chromosome_names[rows]), narrow(feature_types[rows]),
+                                            np.array(start_fields, dtype=bytes)[rows].astype(np.int64),
+                                            np.array(end_fields, dtype=bytes)[rows].astype(np.int64), narrow(transcripts))):
+            column.append(values)
+    dtypes = (bytes, bytes, np.int64, np.int64, bytes)
+    return GtfRecords(*(np.concatenate(column) if column else np.zeros(0, dtype=dtype)
+                        for column, dtype in zip(columns, dtypes)))